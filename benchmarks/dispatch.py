@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Measures the cost of dispatching a call through Command, with the fast
+binder and with ArgumentParser.parse_args.
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shell.command import Command, List
+
+
+def stub(args:List(1)):
+    pass
+
+
+def pair(first, second=None):
+    pass
+
+
+def measure(function, arguments, number=20000):
+    fast = Command(function)
+    slow = Command(function)
+    slow.binder = False
+    results = []
+    for label, command in (('binder', fast), ('argparse', slow)):
+        seconds = min(timeit.repeat(
+            lambda: command(function.__name__, arguments),
+            number=number, repeat=3))
+        results.append((label, seconds / number * 1e6))
+    return results
+
+
+if __name__ == '__main__':
+    cases = [
+        (stub, ['1', '2', '3']),
+        (stub, [str(number) for number in range(1000)]),
+        (pair, ['a']),
+    ]
+    for function, arguments in cases:
+        number = 200 if len(arguments) > 100 else 20000
+        for label, microseconds in measure(function, arguments, number):
+            print('{:<6} {:>5} words  {:<8} {:10.2f} us/call'.format(
+                function.__name__, len(arguments), label, microseconds))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Measures cold start of `python -m shell` on an empty script and fails when
+it exceeds a budget or when a non-interactive run imports a module that
+should only be loaded lazily.
+
+Import times come from -X importtime.  Bytecode is cached in a temporary
+pycache prefix and warmed up first, so the figures do not include
+compiling the sources.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FORBIDDEN = ('readline',)
+
+
+def run(arguments, pycache):
+    environment = dict(os.environ, PYTHONPATH=ROOT)
+    environment.pop('PYTHONDONTWRITEBYTECODE', None)
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-X',
+         'pycache_prefix=' + pycache] + arguments,
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE, universal_newlines=True, env=environment,
+        cwd=ROOT)
+    imports = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        name = name.rstrip()
+        try:
+            cumulative = int(cumulative)
+        except ValueError:
+            continue
+        imports[name.strip()] = (len(name) - len(name.lstrip()), cumulative)
+    return imports
+
+
+def total(imports):
+    """
+    Sum of the cumulative times of top-level imports, in microseconds.
+    """
+    return sum(cumulative for depth, cumulative in imports.values()
+               if depth == 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--budget', type=float, default=40.0,
+                        help='maximum import time in milliseconds added by '
+                             'the shell over a bare interpreter')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        script = os.path.join(directory, 'empty.txt')
+        open(script, 'w').close()
+        pycache = os.path.join(directory, 'pycache')
+        shell = ['-m', 'shell', script]
+        bare = ['-c', 'pass']
+        run(shell, pycache)
+        samples = []
+        for _ in range(args.repeat):
+            imports = run(shell, pycache)
+            samples.append(total(imports) - total(run(bare, pycache)))
+        best = min(samples) / 1000
+
+    print('import time over bare interpreter: {:.1f} ms '
+          '(budget {:.1f} ms)'.format(best, args.budget))
+    status = 0
+    if best > args.budget:
+        print('Startup budget exceeded')
+        status = 1
+    for name in FORBIDDEN:
+        if name in imports:
+            print('{} was imported by a non-interactive run'.format(name))
+            status = 1
+    slowest = sorted(((cumulative, name)
+                      for name, (depth, cumulative) in imports.items()
+                      if depth == 1), reverse=True)[:5]
+    for cumulative, name in slowest:
+        print('  {:8.1f} ms  {}'.format(cumulative / 1000, name))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
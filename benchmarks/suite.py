@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Times the shell's hot paths: parsing realistic and adversarial input,
+Command dispatch, Environment lookups and prompt formatting, and running
+large scripts through send_stream.
+
+Each benchmark reports the best of several runs in microseconds per
+operation.  --save writes the results to a JSON baseline and --compare
+reads one back, reporting the change for every benchmark and exiting with
+status 1 if any became slower than --threshold allows.
+"""
+
+import argparse
+import fnmatch
+import io
+import json
+import os
+import platform
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shell import Shell
+from shell.command import Command, IntList, List
+from shell.environment import AttributeLookup, Environment, ItemLookup
+from shell.parser import Parser
+from shell.template import compile_template
+
+benchmarks = {}
+
+
+def benchmark(name):
+    """
+    Registers a function that returns (function, operations): calling
+    function once performs that many operations.
+    """
+    def register(setup):
+        benchmarks[name] = setup
+        return setup
+    return register
+
+
+SCRIPT = '\n'.join([
+    'echo "hello world"; echo \'single quoted\' plain',
+    'ls -l /tmp | grep {user} # list files',
+    'parallel -j 4 echo ::: one two "three four"',
+    'cd "/some path/with spaces"; echo done &',
+    'echo escaped\\ space "embedded \\"quotes\\"" end',
+]) + '\n'
+
+
+def parse(text, compiled=True):
+    def run():
+        parser = Parser(compiled=compiled)
+        parser.send(text)
+        for _ in parser:
+            pass
+    return run
+
+
+@benchmark('parser.realistic')
+def parser_realistic():
+    return parse(SCRIPT * 200), len(SCRIPT) * 200
+
+
+@benchmark('parser.realistic.reference')
+def parser_reference():
+    return parse(SCRIPT * 200, compiled=False), len(SCRIPT) * 200
+
+
+@benchmark('parser.long_quote')
+def parser_long_quote():
+    text = 'echo "{}"\n'.format('quoted text ' * 20000)
+    return parse(text), len(text)
+
+
+@benchmark('parser.deep_escapes')
+def parser_deep_escapes():
+    text = 'echo {}\n'.format('\\ \\"\\\\' * 20000)
+    return parse(text), len(text)
+
+
+@benchmark('parser.semicolons')
+def parser_semicolons():
+    text = 'a;' * 50000 + '\n'
+    return parse(text), len(text)
+
+
+def stub(first, second=None):
+    pass
+
+
+@benchmark('dispatch.binder')
+def dispatch_binder():
+    command = Command(stub)
+    return lambda: command('stub', ['a', 'b']), 1
+
+
+@benchmark('dispatch.argparse')
+def dispatch_argparse():
+    command = Command(stub)
+    command.binder = False
+    return lambda: command('stub', ['a', 'b']), 1
+
+
+@benchmark('dispatch.shell')
+def dispatch_shell():
+    shell = Shell(stdout=io.StringIO())
+    shell.add_command(stub)
+    return lambda: shell.one_command('stub', ['a', 'b']), 1
+
+
+def total(ids):
+    return sum(int(id) for id in ids)
+
+
+def total_ints(ids:IntList(0)):
+    return sum(ids)
+
+
+def total_words(ids:List(0)):
+    return total(ids)
+
+
+@benchmark('dispatch.list')
+def dispatch_list():
+    command = Command(total_words)
+    words = [str(index) for index in range(100000)]
+    return lambda: command('total', words), len(words)
+
+
+@benchmark('dispatch.int_list')
+def dispatch_int_list():
+    command = Command(total_ints)
+    words = [str(index) for index in range(100000)]
+    return lambda: command('total', words), len(words)
+
+
+class Host:
+    def __init__(self, size):
+        for index in range(size):
+            setattr(self, 'attribute{}'.format(index), index)
+
+
+def environment(size=100):
+    host = Host(size)
+    values = {'item{}'.format(index): index for index in range(size)}
+    namespace = {}
+    for index in range(size):
+        namespace['a{}'.format(index)] = AttributeLookup(
+            host, 'attribute{}'.format(index))
+        namespace['i{}'.format(index)] = ItemLookup(
+            values, 'item{}'.format(index))
+    return Environment(**namespace)
+
+
+@benchmark('environment.lookup')
+def environment_lookup():
+    env = environment()
+    keys = list(env)
+
+    def run():
+        for key in keys:
+            env[key]
+    return run, len(keys)
+
+
+@benchmark('environment.scopes')
+def environment_scopes():
+    env = environment()
+    for depth in range(10):
+        env = env.child(**{'local{}'.format(depth): depth})
+    keys = ['a0', 'i99', 'local0', 'local9']
+    return lambda: [env[key] for key in keys], len(keys)
+
+
+@benchmark('environment.prompt')
+def environment_prompt():
+    env = environment()
+    template = ' '.join('{{a{0}}}:{{i{0}}}'.format(index)
+                        for index in range(0, 100, 5)) + ' $ '
+    compile_template(template)
+    shell = Shell(stdout=io.StringIO(), environment=env, prompt=template)
+    return lambda: shell.get_prompt(False), 1
+
+
+def send_stream(line, count):
+    text = line * count
+
+    def run():
+        shell = Shell(stdout=io.StringIO())
+        shell.add_command(stub)
+        try:
+            shell.send_stream(io.StringIO(text))
+        except SystemExit:
+            pass
+    return run, count
+
+
+@benchmark('send_stream.builtins')
+def send_stream_builtins():
+    return send_stream('stub first "second word"\n', 20000)
+
+
+@benchmark('send_stream.echo')
+def send_stream_echo():
+    return send_stream('echo some words to print; echo more\n', 10000)
+
+
+@benchmark('run_file.cached')
+def run_file_cached():
+    import atexit
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory)
+    path = os.path.join(directory, 'script')
+    with open(path, 'w') as stream:
+        stream.write('stub first "second word"\n' * 20000)
+    shell = Shell(stdout=io.StringIO())
+    shell.add_command(stub)
+    shell.run_file(path)
+    return lambda: shell.run_file(path), 20000
+
+
+@benchmark('control.for_loop')
+def control_for_loop():
+    shell = Shell(stdout=io.StringIO())
+    shell.add_command(stub)
+    line = 'for i in {} {{ stub first $i }}'.format(
+        ' '.join(map(str, range(1000))))
+    shell.send_command(line)
+    return lambda: shell.send_command(line), 1000
+
+
+def measure(setup, repeat, budget):
+    function, operations = setup()
+    number = 1
+    while True:
+        seconds = timeit.timeit(function, number=number)
+        if seconds >= budget / 10 or number >= 1 << 20:
+            break
+        number *= 2
+    seconds = min([seconds] + timeit.repeat(function, number=number,
+                                            repeat=repeat - 1))
+    return seconds / number / operations * 1e6
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, microseconds in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print('{:<30} {:12.4f} us  (new)'.format(name, microseconds))
+            continue
+        change = microseconds / before - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('{:<30} {:12.4f} us  {:+7.1%}{}'.format(
+            name, microseconds, change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('patterns', nargs='*', default=['*'],
+                        help='glob patterns selecting benchmarks')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=0.2,
+                        help='approximate seconds per timing run')
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results to FILE as a baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results with the baseline in FILE')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='slowdown counted as a regression, as a '
+                             'fraction')
+    parser.add_argument('--list', action='store_true',
+                        help='list the benchmarks and exit')
+    args = parser.parse_args()
+
+    names = [name for name in benchmarks
+             if any(fnmatch.fnmatch(name, pattern)
+                    for pattern in args.patterns)]
+    if args.list:
+        print('\n'.join(names))
+        return 0
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as stream:
+            baseline = json.load(stream)['results']
+
+    results = {}
+    for name in names:
+        results[name] = measure(benchmarks[name], args.repeat, args.budget)
+        if baseline is None:
+            print('{:<30} {:12.4f} us'.format(name, results[name]))
+
+    status = 0
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('{} regression(s) over {:.0%}'.format(
+                len(regressions), args.threshold))
+            status = 1
+
+    if args.save:
+        with open(args.save, 'w') as stream:
+            json.dump(dict(python=platform.python_version(),
+                           machine=platform.machine(),
+                           results=results), stream, indent=2)
+            stream.write('\n')
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
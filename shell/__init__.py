@@ -1,12 +1,18 @@
 
-import shlex
+import collections
+import contextlib
+import io
+import os
 import sys
-import traceback
 
 from .environment import Environment
-from .command import Command, List
+from .command import Command, LazyCommand, List, make_command
 from .stream import InputStream
-from .parser import Parser
+from .parser import (Parser, ParseError, StatementCache, PIPE, BACKGROUND,
+                     KEYWORDS)
+from .pipeline import split_stages, run_stage, as_records
+from .template import expand
+from .output import OutputSink, redirect_output
 
 
 class HelpCommand(Command):
@@ -39,7 +45,10 @@ class ExitCommand(Command):
 
 
 class EchoCommand(Command):
-    def __init__(self, environment):
+    # Words are formatted by Shell against whichever scope is current.
+    expand_variables = True
+
+    def __init__(self, environment=None):
         super().__init__(name='echo')
         self.environment = environment
 
@@ -47,7 +56,18 @@ class EchoCommand(Command):
         """
         Print arguments to stdout
         """
-        print(' '.join(word.format(**self.environment) for word in words))
+        print(' '.join(words))
+
+
+class LazyScheduler:
+    """
+    Defers creating a shell's JobScheduler until a job command uses it.
+    """
+    def __init__(self, shell):
+        self.shell = shell
+
+    def __getattr__(self, attribute):
+        return getattr(self.shell.scheduler, attribute)
 
 
 def instantiate(class_or_object, *args, **kwargs):
@@ -63,10 +83,21 @@ def instantiate(class_or_object, *args, **kwargs):
 class Shell:
     def __init__(self, prompt='$ ', prompt2='> ', history=None,
                  use_rawinput=True, completekey='tab', stdout=sys.stdout,
-                 parser=None, environment=Environment):
+                 parser=None, environment=Environment,
+                 statement_cache_size=0, output_buffer_size=1 << 16,
+                 line_buffering=None, history_length=1000,
+                 source_cache_dir=None, commands=None):
         self.parser = parser or Parser()
+        self.statement_cache = (
+            StatementCache(statement_cache_size)
+            if statement_cache_size else None)
         self.stdout = stdout
+        # Commands print through this sink while statements run.
+        self.output = OutputSink(stdout, output_buffer_size, line_buffering)
         self.history = history
+        self.history_length = history_length
+        self.source_cache_dir = source_cache_dir
+        self._history_store = None
         self.use_rawinput = use_rawinput
         self.completekey = completekey
         self.environment = instantiate(environment)
@@ -74,10 +105,53 @@ class Shell:
             prompt=prompt,
             prompt2=prompt2,
         )
-        self.commands = dict()
-        self.add_command(ExitCommand)
-        self.add_command(HelpCommand(self.commands))
-        self.add_command(EchoCommand(self.environment))
+        self.last_error = None
+        self._scheduler = None
+        self._path_cache = None
+        self._completer = None
+        self._command_index = None
+        # A Hooks object only while callbacks are registered.
+        self.hooks = None
+        self.stats = None
+        # The if, for, while or function construct being read, if any.
+        self.construct = None
+        # Changes whenever a name is bound to a different command.
+        self.command_version = 0
+        if commands is None:
+            self.commands = dict()
+        else:
+            # Commands registered here shadow, but never change, the shared
+            # ones.
+            self.commands = collections.ChainMap({}, commands)
+        self.add_lazy_command('exit', ExitCommand)
+        self.add_lazy_command('help', HelpCommand, self.commands)
+        self.add_lazy_command('echo', EchoCommand)
+        self.add_lazy_command('parallel', 'shell.parallel:ParallelCommand',
+                              self)
+        self.add_lazy_command('hash', 'shell.external:HashCommand', self)
+        self.add_lazy_command('history', 'shell.history:HistoryCommand',
+                              self)
+        self.add_lazy_command('source', 'shell.source:SourceCommand', self)
+        self.add_lazy_command('alias', 'shell.functions:AliasCommand', self)
+        for name in ('time', 'profile', 'stats'):
+            self.add_lazy_command(
+                name, 'shell.instrument:{}Command'.format(name.capitalize()),
+                self)
+        for name in ('jobs', 'wait', 'cancel'):
+            self.add_lazy_command(
+                name, 'shell.jobs:{}Command'.format(name.capitalize()),
+                LazyScheduler(self))
+
+    def session(self, stdout, **kwargs):
+        """
+        Returns a new Shell for another user of this one.  It shares the
+        commands registered here, including any added later, but has its
+        own parser, output and child scope of the environment.
+        """
+        kwargs.setdefault('prompt', self.environment.get('prompt', '$ '))
+        kwargs.setdefault('prompt2', self.environment.get('prompt2', '> '))
+        return type(self)(stdout=stdout, commands=self.commands,
+                          environment=self.environment.child(), **kwargs)
 
     def add_command(self, class_or_object=None):
         if class_or_object is None:
@@ -86,57 +160,454 @@ class Shell:
                 return function
             return add_command
 
-        if isinstance(class_or_object, Command):
-            instance = class_or_object
-        elif (isinstance(class_or_object, type) and
-              issubclass(class_or_object, Command)):
-            instance = class_or_object()
-        else:
-            instance = Command(class_or_object)
-        self.commands[instance.name] = instance
-        return instance
+        instance = make_command(class_or_object)
+        return self.set_command(instance.name, instance)
+
+    def set_command(self, name, command):
+        """
+        Register command, which need only be called like a Command, as
+        name, replacing whatever had that name.
+        """
+        self.commands[name] = command
+        if self._command_index is not None:
+            self._command_index.add(name)
+        self.command_version += 1
+        return command
+
+    def remove_command(self, name):
+        del self.commands[name]
+        self.command_version += 1
+        if self._command_index is not None and name not in self.commands:
+            self._command_index.discard(name)
+
+    def add_lazy_command(self, name, target, *args, **kwargs):
+        """
+        Register name without building its Command.  target and any extra
+        arguments are passed to make_command on first use; target may also
+        be a 'module:attribute' string, which is imported at that point.
+        """
+        stub = LazyCommand(name, target, *args, registry=self.commands,
+                           **kwargs)
+        return self.set_command(name, stub)
+
+    def discover_commands(self, group='shell.commands'):
+        """
+        Register every entry point in group as a lazy command named after
+        the entry point.  Plugin modules are not imported until used.
+        """
+        from importlib.metadata import entry_points
+        for entry_point in entry_points(group=group):
+            self.add_lazy_command(entry_point.name, entry_point)
 
     def get_prompt(self, continued):
         if continued:
             prompt = self.environment.get('prompt2', '')
         else:
             prompt = self.environment.get('prompt', '$ ')
-        return prompt.format(**self.environment)
+        return expand(prompt, self.environment)
+
+    def expand_arguments(self, instance, arguments, environment=None):
+        if getattr(instance, 'expand_variables', False):
+            if environment is None:
+                environment = self.environment
+            # Most words have no fields, and need no template.
+            return [expand(argument, environment)
+                    if '{' in argument or '}' in argument else argument
+                    for argument in arguments]
+        return arguments
+
+    @property
+    def scheduler(self):
+        """
+        The JobScheduler for background jobs and async commands, created
+        (and asyncio imported) on first use.
+        """
+        if self._scheduler is None:
+            from .jobs import JobScheduler
+            self._scheduler = JobScheduler(self)
+        return self._scheduler
+
+    @property
+    def completer(self):
+        """
+        The Completer used for tab completion.
+        """
+        if self._completer is None:
+            from .completion import Completer
+            self._completer = Completer(self)
+        return self._completer
+
+    @property
+    def command_index(self):
+        """
+        A PrefixIndex of the command names, for completion.
+        """
+        if self._command_index is None:
+            from .completion import PrefixIndex
+            self._command_index = PrefixIndex(self.commands)
+        return self._command_index
+
+    @property
+    def path_cache(self):
+        """
+        The PathCache used to find external programs.
+        """
+        if self._path_cache is None:
+            from .external import PathCache
+            self._path_cache = PathCache()
+        return self._path_cache
+
+    @property
+    def history_store(self):
+        """
+        The History kept in history + '.db', or None without a history
+        file.  Lines already in the history file itself are imported once.
+        """
+        if self._history_store is None and self.history:
+            from .history import History
+            path = os.path.expanduser(self.history)
+            self._history_store = History(path + '.db', legacy=path)
+        return self._history_store
+
+    def parallel(self, command, argument_sets, jobs=None, processes=None):
+        """
+        Run the named command once per list of arguments in argument_sets
+        on a pool of threads or processes.  See shell.parallel.run_parallel.
+        """
+        from .parallel import run_parallel
+        if command not in self.commands:
+            raise LookupError('No such command: {!r}'.format(command))
+        run_parallel(self.commands[command], argument_sets, jobs, processes)
+
+    def add_hook(self, kind, function):
+        """
+        Register a 'before', 'after', 'error' or 'parse' callback; see
+        shell.instrument.Hooks for their arguments.
+        """
+        if self.hooks is None:
+            from .instrument import Hooks
+            self.hooks = Hooks()
+        return self.hooks.add(kind, function)
+
+    def remove_hook(self, kind, function):
+        self.hooks.remove(kind, function)
+        if not self.hooks:
+            self.hooks = None
+
+    def collect_stats(self):
+        """
+        Start collecting per-command statistics and return the Stats.
+        """
+        if self.stats is None:
+            from .instrument import Stats
+            self.stats = Stats()
+            self.stats.install(self)
+        return self.stats
+
+    def dispatch(self, command, arguments, wait=True, environment=None):
+        """
+        Run one command, letting any exception propagate.  Coroutines
+        returned by async commands are awaited unless wait is false, in
+        which case they are returned.  Arguments are expanded with
+        environment, or the shell's current one if it is None.
+        """
+        if self.hooks is not None:
+            return self.hooks.call(
+                self._dispatch, command, arguments, wait, environment)
+        return self._dispatch(command, arguments, wait, environment)
+
+    def _dispatch(self, command, arguments, wait, environment=None):
+        if command not in self.commands:
+            return self.default(command, arguments)
+        return self._invoke(command, arguments, self.commands[command], wait,
+                            environment)
+
+    def _invoke(self, command, arguments, instance, wait=True,
+                environment=None):
+        arguments = self.expand_arguments(instance, arguments, environment)
+        result = instance(command, arguments)
+        if hasattr(result, '__await__'):
+            if not wait:
+                return result
+            result = self.scheduler.run(result)
+        self.print_result(result)
+        return result
+
+    def call_resolved(self, instance, command, arguments, environment=None):
+        """
+        Like dispatch, for a command already looked up as instance.
+        """
+        if self.hooks is not None:
+            return self.hooks.call(
+                self._invoke, command, arguments, instance, True, environment)
+        return self._invoke(command, arguments, instance, True, environment)
 
     def one_command(self, command, arguments):
         try:
+            result = self.dispatch(command, arguments)
+        except Exception as error:
+            self.last_error = error
+        else:
+            self.last_error = None
+            return result
+
+    def call_pipeline(self, statement, environment=None):
+        """
+        Run the stages of a statement containing PIPE markers as a chain of
+        iterators, printing whatever reaches the end.  Adjacent external
+        programs are connected to each other directly.
+        """
+        stages = split_stages(statement)
+        records = None
+        index = 0
+        while index < len(stages):
+            command, arguments = stages[index]
+            index += 1
             if command in self.commands:
-                return self.commands[command](command, arguments)
+                instance = self.commands[command]
+                arguments = self.expand_arguments(
+                    instance, arguments, environment)
+                records = run_stage(instance, command, arguments, records)
+                continue
+            path = self.path_cache.lookup(command)
+            if path is None:
+                # Reports the missing command and raises.
+                self.default(command, arguments)
+            group = [(path, [command] + list(arguments))]
+            while (index < len(stages) and
+                   stages[index][0] not in self.commands):
+                command, arguments = stages[index]
+                path = self.path_cache.lookup(command)
+                if path is None:
+                    break
+                group.append((path, [command] + list(arguments)))
+                index += 1
+            from .external import external_records, run_group
+            if index == len(stages):
+                run_group(group, records)
+                records = None
             else:
-                return self.default(command, arguments)
+                records = external_records(group, records)
+        if records is not None:
+            self.print_records(records)
+
+    def run_pipeline(self, statement):
+        try:
+            self.call_pipeline(statement)
         except Exception as error:
             self.last_error = error
         else:
             self.last_error = None
 
+    def print_result(self, result):
+        records = as_records(result)
+        if records is not None:
+            self.print_records(records)
+
+    def print_records(self, records):
+        for record in records:
+            print(record)
+
+    def call_statement(self, statement, wait=True, environment=None):
+        if PIPE in statement:
+            return self.call_pipeline(statement, environment)
+        return self.dispatch(statement[0], statement[1:], wait, environment)
+
+    def run_statement(self, statement):
+        if self.construct is not None or statement[0] in KEYWORDS:
+            return self.run_construct(statement)
+        if statement[-1] is BACKGROUND:
+            job = self.scheduler.submit(statement[:-1])
+            print('[{}]'.format(job.id))
+            return job
+        if PIPE in statement:
+            return self.run_pipeline(statement)
+        return self.one_command(statement[0], statement[1:])
+
+    def run_construct(self, statement):
+        """
+        Collect the statements of an if, for, while or function construct,
+        then compile and run it once its braces balance.
+        """
+        from .control import Construct
+        if self.construct is None:
+            self.construct = Construct(statement)
+        else:
+            self.construct.add(statement)
+        if not self.construct.complete:
+            return
+        construct, self.construct = self.construct, None
+        try:
+            construct.run(self)
+        except ParseError as error:
+            print(error)
+            self.last_error = error
+
     def default(self, command, arguments):
+        """
+        Run command as an external program found on PATH, or fail with
+        LookupError if there is none.
+        """
+        path = self.path_cache.lookup(command)
+        if path is not None:
+            from .external import run_group
+            try:
+                return run_group([(path, [command] + list(arguments))])
+            except FileNotFoundError:
+                # The remembered location is stale; look it up again.
+                self.path_cache.forget(command)
+                path = self.path_cache.lookup(command)
+                if path is not None:
+                    return run_group([(path, [command] + list(arguments))])
         print('No such command: {!r}'.format(command))
+        raise LookupError('No such command: {!r}'.format(command))
 
     def run_statements(self):
-        for statement in self.parser:
-            self.one_command(statement[0], statement[1:])
+        with redirect_output(self.output):
+            try:
+                statements = self.parser
+                if self.hooks is not None:
+                    statements = self.hooks.timed(statements)
+                for statement in statements:
+                    self.run_statement(statement)
+            except ParseError as error:
+                print(error)
+                self.last_error = error
+
+    def run_file(self, path, cache=True, check_hash=False):
+        """
+        Run the script at path.  Its parsed statements are cached on disk,
+        in source_cache_dir or beside the script, so that later runs of an
+        unchanged script skip parsing.  Nothing runs if the script does not
+        parse.
+        """
+        from . import source
+        with redirect_output(self.output):
+            try:
+                if cache:
+                    statements = source.load_statements(
+                        path, self.parser, self.source_cache_dir, check_hash)
+                else:
+                    with open(path, encoding='utf-8') as stream:
+                        statements = source.parse(stream.read(), self.parser)
+                for statement in statements:
+                    self.run_statement(statement)
+            except ParseError as error:
+                print(error)
+                self.last_error = error
+        self.output.flush()
+
+    @contextlib.contextmanager
+    def capture(self):
+        """
+        Collect output in memory instead of writing it to stdout.  Yields
+        the io.StringIO that receives it; everything is in it by the time
+        send_command returns or the block ends.
+        """
+        self.output.flush()
+        captured = io.StringIO()
+        stream, self.output.stream = self.output.stream, captured
+        try:
+            yield captured
+        finally:
+            self.output.flush()
+            self.output.stream = stream
+
+    def push_scope(self, **variables):
+        """
+        Make a new child scope of the environment current and return it.
+        """
+        self.environment = self.environment.child(**variables)
+        return self.environment
+
+    def pop_scope(self):
+        """
+        Discard the current scope, returning to its parent.
+        """
+        self.environment = self.environment.parent
 
-    def send_command(self, command):
-        self.parser.send_line(command + '\n')
-        self.run_statements()
-        self.parser.__init__()
+    def send_command(self, command, **variables):
+        """
+        Run one line of input.  Any variables are set in a temporary scope
+        that is discarded once the line has run.
+        """
+        if variables:
+            self.push_scope(**variables)
+            try:
+                return self.send_command(command)
+            finally:
+                self.pop_scope()
+        with redirect_output(self.output):
+            try:
+                self._send_command(command)
+            finally:
+                self.output.flush()
+
+    def _send_command(self, command):
+        cache = self.statement_cache
+        if (cache is None or self.parser.chunks or
+                not self.parser.is_complete()):
+            self.parser.send_line(command + '\n')
+            self.run_statements()
+            self.parser.reset()
+            return
+        statements = cache.get(command)
+        if statements is None:
+            self.parser.send_line(command + '\n')
+            try:
+                statements = tuple(tuple(statement)
+                                   for statement in self.parser)
+            except ParseError as error:
+                print(error)
+                self.last_error = error
+                return
+            # Lines ending inside a quote or escape are never cached.
+            if self.parser.is_complete():
+                cache.put(command, statements)
+            self.parser.reset()
+        for statement in statements:
+            self.run_statement(statement)
+
+    def send_blocks(self, blocks):
+        """
+        Parse and run text arriving in arbitrary blocks, as from a file or
+        pipe.  CR LF line endings become LF, as when reading lines, and a
+        final line without a line ending is still run.
+        """
+        text = pending = ''
+        for block in blocks:
+            block = pending + block
+            # A CR at the end may be the start of a CR LF.
+            pending = '\r' if block.endswith('\r') else ''
+            block = block[:len(block) - len(pending)].replace('\r\n', '\n')
+            if block:
+                text = block
+                self.parser.send(block)
+                self.run_statements()
+        if pending:
+            text = pending
+            self.parser.send(pending)
+        if text and not text.endswith('\n'):
+            self.parser.send('\n')
+            self.run_statements()
+        self.output.flush()
 
     def send_stream(self, stream):
         input_stream = InputStream(self, stream)
         try:
-            for line in input_stream:
-                self.parser.send_line(line)
-                self.run_statements()
             if input_stream.isatty:
+                for line in input_stream:
+                    self.parser.send_line(line)
+                    self.run_statements()
                 input_stream.stdout.write('exit\n')
                 input_stream.stdout.flush()
-            self.commands['exit']('exit', [0])
+            else:
+                self.send_blocks(input_stream.blocks())
+            # As the exit command would, without building it.
+            raise SystemExit(0)
         except KeyboardInterrupt:
             pass
         except SystemExit:
             raise
+        finally:
+            self.output.flush()
@@ -12,12 +12,21 @@ parser = argparse.ArgumentParser()
 parser.add_argument('stdin', nargs='?', type=argparse.FileType('r'),
                     default=sys.stdin)
 parser.add_argument('arguments', nargs=argparse.REMAINDER)
+mode = parser.add_mutually_exclusive_group()
+mode.add_argument('--serve', metavar='SOCKET',
+                  help='serve sessions to clients connecting to SOCKET')
+mode.add_argument('--connect', metavar='SOCKET',
+                  help='run a session of the server listening on SOCKET')
 
 args = parser.parse_args()
 
+if args.connect:
+    from .server import connect
+    connect(args.connect)
+    sys.exit()
+
 shell = Shell(stdout=sys.stdout)
 
-@shell.add_command
 def stub(args:List(1)):
     """
     Prints arguments as a python list
@@ -25,26 +34,33 @@ def stub(args:List(1)):
     print(list(args))
 
 
-import inspect
-
-
 class Error(Parameter):
-    exceptions = dict(
-        (name, member) for name, member in inspect.getmembers(__builtins__)
-        if isinstance(member, type) and issubclass(member, BaseException)
-        and not issubclass(member, Warning))
+    _exceptions = None
+
+    @classmethod
+    def exceptions(cls):
+        """
+        Builtin exception classes by name, collected on first use.
+        """
+        if cls._exceptions is None:
+            import builtins
+            cls._exceptions = dict(
+                (name, member) for name, member in vars(builtins).items()
+                if isinstance(member, type) and
+                issubclass(member, BaseException) and
+                not issubclass(member, Warning))
+        return cls._exceptions
 
     def __call__(self, value):
         return value
 
     def add_to(self, parameter, command):
         command.add_argument(
-            parameter.name, choices=self.exceptions.keys(), nargs='?',
+            parameter.name, choices=self.exceptions().keys(), nargs='?',
             default=parameter.default,
             type=lambda name:getattr(__builtins__, name))
 
 
-@shell.add_command
 def fail(exception:Error()=Exception):
     """
     Raise an exception
@@ -52,6 +68,14 @@ def fail(exception:Error()=Exception):
     raise exception
 
 
+shell.add_lazy_command('stub', stub)
+shell.add_lazy_command('fail', fail)
+
+
 shell.arguments = args.arguments
 
-shell.send_stream(args.stdin)
+if args.serve:
+    from .server import serve
+    serve(shell, args.serve)
+else:
+    shell.send_stream(args.stdin)
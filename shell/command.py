@@ -1,17 +1,124 @@
 
-from argparse import ArgumentParser, REMAINDER
-import inspect
+from argparse import (ArgumentParser, REMAINDER, OPTIONAL, ZERO_OR_MORE,
+                      ONE_OR_MORE, _StoreAction, _HelpAction)
+from array import array
+import sys
 
-empty = inspect.Parameter.empty
+
+def is_empty(value):
+    """
+    True if value is inspect.Parameter.empty.
+    """
+    # Imported here, since only building a Command needs it.
+    import inspect
+    return value is inspect.Parameter.empty
+
+
+class UsageError(Exception):
+    """
+    Raised instead of exiting when a Command rejects its arguments, after
+    the usage and the error have been printed.
+    """
+
+
+class Binder:
+    """
+    Maps a list of words straight to keyword arguments for commands whose
+    arguments are all untyped positionals, allocating words greedily in the
+    same way as ArgumentParser.  Returns None whenever argparse is needed:
+    for option flags, --help, or words that do not fit, so that errors and
+    help output still come from argparse.
+    """
+    def __init__(self, positionals, prefix_chars):
+        self.positionals = positionals
+        self.prefixes = tuple(prefix_chars)
+        self.minimum = sum(minimum for _, minimum, _, _, _ in positionals)
+
+    @classmethod
+    def from_parser(cls, parser):
+        positionals = []
+        for action in parser._actions:
+            if isinstance(action, _HelpAction):
+                continue
+            if (type(action) is not _StoreAction or action.option_strings
+                    or action.type is not None
+                    or action.choices is not None):
+                return None
+            nargs = action.nargs
+            if nargs is None:
+                bounds = (1, 1, True)
+            elif nargs == OPTIONAL:
+                bounds = (0, 1, True)
+            elif nargs in (ZERO_OR_MORE, REMAINDER):
+                bounds = (0, None, False)
+            elif nargs == ONE_OR_MORE:
+                bounds = (1, None, False)
+            elif isinstance(nargs, int):
+                bounds = (nargs, nargs, False)
+            else:
+                return None
+            minimum, maximum, single = bounds
+            default = action.default
+            if nargs == REMAINDER:
+                default = None
+            positionals.append(
+                (action.dest, minimum, maximum, single, default))
+        return cls(positionals, parser.prefix_chars)
+
+    def __call__(self, arguments):
+        prefixes = self.prefixes
+        try:
+            for argument in arguments:
+                if argument.startswith(prefixes):
+                    return None
+        except AttributeError:
+            # Non-string words, such as the status passed to exit.
+            return None
+        remaining = len(arguments)
+        required = self.minimum
+        index = 0
+        values = {}
+        for dest, minimum, maximum, single, default in self.positionals:
+            required -= minimum
+            count = remaining - required
+            if maximum is not None and count > maximum:
+                count = maximum
+            if count < minimum:
+                return None
+            if single:
+                values[dest] = arguments[index] if count else default
+            elif count or default is None:
+                values[dest] = list(arguments[index:index + count])
+            else:
+                values[dest] = default
+            index += count
+            remaining -= count
+        if remaining:
+            return None
+        return values
 
 class Command(ArgumentParser):
+    # When true, Shell formats each argument with the environment first.
+    expand_variables = False
+    # Name of the parameter annotated with Records, if any.
+    records_parameter = None
+    # When true, parallel runs this command in worker processes.
+    cpu_bound = False
+    # Names of the attributes of a bare ArgumentParser, found when a
+    # Command is first pickled.
+    parser_attributes = None
+
     def __init__(self, function=None, name=None, **kwargs):
         if function is not None:
             self.run = function
         kwargs.setdefault('prog', name or function.__name__)
         kwargs.setdefault('description', function.__doc__)
         self.name = kwargs['prog']
+        self.binder = None
+        # Parameters whose words are converted as a whole after binding.
+        self.converters = {}
         super().__init__(**kwargs)
+        import inspect
         signature = inspect.signature(self.run)
         for parameter in signature.parameters.values():
             if isinstance(parameter.annotation, Parameter):
@@ -24,17 +131,77 @@ class Command(ArgumentParser):
             elif parameter.kind == parameter.VAR_POSITIONAL:
                 self.add_argument(parameter.name, nargs=REMAINDER)
 
-    def __call__(self, command, arguments):
-        try:
-            arguments = self.parse_args(arguments)
-        except SystemExit:
-            # SystemExit is generated by --help.  We catch it here to
-            #  return to the shell instead of shutting down completely.
+    def bind(self, arguments):
+        """
+        Returns the keyword arguments for run, or None if argparse exited
+        after printing help.  Raises UsageError for arguments that it
+        rejects.
+        """
+        if self.binder is None:
+            self.binder = Binder.from_parser(self) or False
+        values = self.binder(arguments) if self.binder else None
+        if values is None:
+            try:
+                values = vars(self.parse_args(arguments))
+            except SystemExit:
+                # SystemExit is generated by --help.  We catch it here to
+                #  return to the shell instead of shutting down completely.
+                return None
+        for dest, convert in self.converters.items():
+            value = values.get(dest)
+            if not isinstance(value, list):
+                # Left at its default.
+                continue
+            try:
+                values[dest] = convert(value)
+            except (ValueError, OverflowError) as error:
+                self.error('argument {}: {}'.format(dest, error))
+        return values
+
+    def error(self, message):
+        self.print_usage(sys.stderr)
+        print('{}: error: {}'.format(self.prog, message), file=sys.stderr)
+        raise UsageError('{}: {}'.format(self.prog, message))
+
+    def __call__(self, command, arguments, records=None):
+        values = self.bind(arguments)
+        if values is None:
             return
-        self.run(**vars(arguments))
+        if self.records_parameter is not None:
+            values[self.records_parameter] = (
+                iter(()) if records is None else records)
+        return self.run(**values)
+
+    def __getstate__(self):
+        """
+        Pickles only what run needs, for worker processes: argparse's own
+        state holds local functions.  A function passed to the constructor
+        is pickled by name, since add_command may have bound its name to
+        this Command.
+        """
+        if Command.parser_attributes is None:
+            Command.parser_attributes = frozenset(
+                vars(ArgumentParser(add_help=False)))
+        state = {key: value for key, value in vars(self).items()
+                 if key not in Command.parser_attributes}
+        run = state.get('run')
+        if run is not None and hasattr(run, '__code__'):
+            if '<' in run.__qualname__:
+                raise TypeError('{} is not defined at module level'.format(
+                    run.__qualname__))
+            state['run'] = (run.__module__, run.__qualname__)
+        return state
+
+    def __setstate__(self, state):
+        run = state.get('run')
+        if isinstance(run, tuple):
+            run = import_object(*run)
+            state['run'] = run.run if isinstance(run, Command) else run
+        vars(self).update(state)
 
     def add_argument(self, *args, **kwargs):
-        if kwargs.get('default') is empty:
+        self.binder = None
+        if 'default' in kwargs and is_empty(kwargs['default']):
             del kwargs['default']
         if ('metavar' not in kwargs and
               kwargs.get('nargs') in ('*', '+', REMAINDER) and
@@ -46,18 +213,104 @@ class Command(ArgumentParser):
         return super().add_argument(*args, **kwargs)
 
 
+def import_object(module, attribute=''):
+    """
+    Returns the object named by the dotted attribute in module.
+    """
+    import importlib
+    target = importlib.import_module(module)
+    for name in attribute.split('.') if attribute else ():
+        target = getattr(target, name)
+    return target
+
+
+def make_command(class_or_object, *args, **kwargs):
+    """
+    Returns a Command built from a Command instance, a Command subclass or
+    a plain function.
+    """
+    if isinstance(class_or_object, Command):
+        return class_or_object
+    elif (isinstance(class_or_object, type) and
+          issubclass(class_or_object, Command)):
+        return class_or_object(*args, **kwargs)
+    else:
+        return Command(class_or_object, *args, **kwargs)
+
+
+class LazyCommand:
+    """
+    Stands in for a command until it is first called or asked for help.
+
+    target may be anything accepted by make_command, a 'module:attribute'
+    string, or an entry point; modules are only imported on first use.
+    Once built, the command replaces this stub in registry.
+    """
+    def __init__(self, name, target, *args, registry=None, **kwargs):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs
+        self.registry = registry
+        self.command = None
+
+    def resolve(self):
+        if self.command is None:
+            target = self.target
+            if isinstance(target, str):
+                module, _, attribute = target.partition(':')
+                target = import_object(module, attribute)
+            elif hasattr(target, 'load') and hasattr(target, 'group'):
+                target = target.load()
+            self.command = make_command(target, *self.args, **self.kwargs)
+            if (self.registry is not None and
+                    self.registry.get(self.name) is self):
+                self.registry[self.name] = self.command
+        return self.command
+
+    def __call__(self, command, arguments, records=None):
+        return self.resolve()(command, arguments, records)
+
+    def print_help(self, file=None):
+        return self.resolve().print_help(file)
+
+    def __getattr__(self, attribute):
+        if attribute.startswith('__') or attribute in vars(LazyCommand):
+            raise AttributeError(attribute)
+        return getattr(self.resolve(), attribute)
+
+
 class Parameter:
     pass
 
 
 class List(Parameter):
+    """
+    Collects words into one parameter.  List(n) takes any number of them
+    and List(start, stop) from start to stop.  If multiple_of is given, the
+    number of words must be a multiple of it.
+    """
     def __init__(self, start, stop=None, multiple_of=None):
         self.minimum = 0 if stop is None else start
         self.maximum = start if stop is None else stop
+        self.bounded = stop is not None
         self.multiple_of = multiple_of
 
-    def __call__(self, value):
-        return value
+    def __call__(self, values):
+        """
+        Checks the number of values and returns them converted.
+        """
+        count = len(values)
+        if count < self.minimum or self.bounded and count > self.maximum:
+            raise ValueError('expected {} to {} values, got {}'.format(
+                self.minimum, self.maximum, count))
+        if self.multiple_of and count % self.multiple_of:
+            raise ValueError('expected a multiple of {} values, got {}'.format(
+                self.multiple_of, count))
+        return self.convert(values)
+
+    def convert(self, values):
+        return values
 
     def add_to(self, parameter, command):
         kwargs = dict(default=parameter.default)
@@ -68,3 +321,159 @@ class List(Parameter):
         else:
             kwargs['nargs'] = self.maximum
         command.add_argument(parameter.name, **kwargs)
+        command.converters[parameter.name] = self
+
+
+class ArrayList(List):
+    """
+    A List converted in one step into an array.array of typecode, with
+    each word converted by type.
+    """
+    typecode = None
+    type = None
+
+    def convert(self, values):
+        # map runs the conversion in C, without a Python loop per word.
+        return array(self.typecode, map(self.type, values))
+
+
+class IntList(ArrayList):
+    """
+    A List of integers, passed as an array of 64-bit signed integers.
+
+    >>> IntList(0)(['1', '-2', '30'])
+    array('q', [1, -2, 30])
+    """
+    typecode = 'q'
+    type = int
+
+
+class FloatList(ArrayList):
+    """
+    A List of numbers, passed as an array of doubles.
+
+    >>> FloatList(0, 4, multiple_of=2)(['1.5', '2', '-3e2', 'inf'])
+    array('d', [1.5, 2.0, -300.0, inf])
+    """
+    typecode = 'd'
+    type = float
+
+
+class PathList(List):
+    """
+    A List of paths, passed as a tuple of pathlib.Path objects.  Empty
+    words are rejected rather than taken as the current directory.
+    """
+    def convert(self, values):
+        if '' in values:
+            raise ValueError('empty path')
+        from pathlib import Path
+        return tuple(map(Path, values))
+
+
+class NumPyList(List):
+    """
+    A List passed as a NumPy array of dtype, converted from the words in a
+    single step.  NumPy is only imported when the command is first run.
+    """
+    def __init__(self, start, stop=None, multiple_of=None, dtype='int64'):
+        super().__init__(start, stop, multiple_of)
+        self.dtype = dtype
+
+    def convert(self, values):
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError('NumPyList needs numpy, which is not installed')
+        return numpy.array(values, dtype=str).astype(self.dtype)
+
+
+class Records(Parameter):
+    """
+    Marks the parameter that receives the records produced by the previous
+    stage of a pipeline, as an iterator.  It takes no words from the
+    command line.  A command that returns an iterator passes its records on
+    to the next stage lazily.
+    """
+    def add_to(self, parameter, command):
+        command.records_parameter = parameter.name
+
+
+if __name__ == '__main__':
+
+    import inspect
+    import io
+    import itertools
+
+    def test_binding(function, *argument_lists):
+        command = Command(function)
+        binder = Binder.from_parser(command)
+        if binder is None:
+            print('*' * 40)
+            print('No fast binder for {}{}'.format(
+                function.__name__, inspect.signature(function)))
+            return
+        for arguments in argument_lists:
+            streams = sys.stdout, sys.stderr
+            sys.stdout = sys.stderr = io.StringIO()
+            try:
+                expected = vars(command.parse_args(arguments))
+            except (SystemExit, UsageError):
+                expected = None
+            finally:
+                sys.stdout, sys.stderr = streams
+            got = binder(arguments)
+            flagged = any(argument.startswith('-') for argument in arguments)
+            if got != expected and (got is not None or not flagged):
+                print('*' * 40)
+                print('Binding {}{} to {!r}:'.format(
+                    function.__name__, inspect.signature(function),
+                    arguments))
+                print('\tExpected: {!r}'.format(expected))
+                print('\tGot: {!r}'.format(got))
+
+    words = [list(itertools.repeat('w', count)) for count in range(5)]
+
+    def zero(): pass
+    def one(a): pass
+    def optional(a, b=None, c='c'): pass
+    def words_(words:List(0)): pass
+    def leading(a, words:List(1), b=5): pass
+    def fixed(words:List(2, 2), b=None): pass
+    def rest(a, *rest): pass
+
+    for function in (zero, one, optional, words_, leading, fixed, rest):
+        test_binding(function, *words)
+    test_binding(one, ['-h'], ['--', 'x'], ['-1'], [''])
+
+    def test_conversion(function, arguments, expected):
+        command = Command(function)
+        streams = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = io.StringIO()
+        try:
+            got = command.bind(arguments)
+        except UsageError:
+            got = None
+        finally:
+            sys.stdout, sys.stderr = streams
+        if got is not None:
+            got = {key: list(value) if isinstance(value, array) else value
+                   for key, value in got.items()}
+        if got != expected:
+            print('*' * 40)
+            print('Converting {!r} for {}{}:'.format(
+                arguments, function.__name__, inspect.signature(function)))
+            print('\tExpected: {!r}'.format(expected))
+            print('\tGot: {!r}'.format(got))
+
+    def ints(ids:IntList(0)): pass
+    def pairs(a, points:FloatList(0, 6, multiple_of=2)=None): pass
+
+    test_conversion(ints, ['1', '-2', '3'], dict(ids=[1, -2, 3]))
+    test_conversion(ints, [], dict(ids=[]))
+    test_conversion(ints, ['1', 'x'], None)
+    test_conversion(ints, [str(1 << 63)], None)
+    test_conversion(pairs, ['a'], dict(a='a', points=[]))
+    test_conversion(pairs, ['a', '1', '2.5'], dict(a='a', points=[1.0, 2.5]))
+    test_conversion(pairs, ['a', '1', '2', '3'], None)
+    test_conversion(pairs, ['a'] + ['1'] * 8, None)
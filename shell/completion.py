@@ -0,0 +1,148 @@
+
+import bisect
+import os
+from collections import OrderedDict
+
+
+class PrefixIndex:
+    """
+    A sorted list of words that finds every word starting with a prefix
+    with two binary searches.
+    """
+    def __init__(self, words=()):
+        self.words = sorted(set(words))
+
+    def add(self, word):
+        index = bisect.bisect_left(self.words, word)
+        if index == len(self.words) or self.words[index] != word:
+            self.words.insert(index, word)
+
+    def discard(self, word):
+        index = bisect.bisect_left(self.words, word)
+        if index < len(self.words) and self.words[index] == word:
+            del self.words[index]
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        index = bisect.bisect_left(self.words, word)
+        return index < len(self.words) and self.words[index] == word
+
+    def matches(self, prefix):
+        start = bisect.bisect_left(self.words, prefix)
+        stop = bisect.bisect_left(self.words, prefix + '\U0010ffff', start)
+        return self.words[start:stop]
+
+
+class DirectoryCache:
+    """
+    Remembers the listings of recently completed directories until their
+    modification time changes.
+    """
+    def __init__(self, size=32):
+        self.size = size
+        self.listings = OrderedDict()
+
+    def listing(self, directory):
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return PrefixIndex()
+        cached = self.listings.get(directory)
+        if cached is not None and cached[0] == mtime:
+            self.listings.move_to_end(directory)
+            return cached[1]
+        try:
+            with os.scandir(directory) as entries:
+                names = [entry.name + os.sep if entry.is_dir() else entry.name
+                         for entry in entries]
+        except OSError:
+            names = []
+        index = PrefixIndex(names)
+        self.listings[directory] = (mtime, index)
+        if len(self.listings) > self.size:
+            self.listings.popitem(last=False)
+        return index
+
+
+class Completer:
+    """
+    Completes command names, a command's options and choices, environment
+    variables written as {name}, and paths.
+    """
+    separators = ';|&'
+
+    def __init__(self, shell):
+        self.shell = shell
+        self.commands = shell.command_index
+        self.arguments = {}
+        self.variables = None
+        self.directories = DirectoryCache()
+
+    def command_matches(self, text):
+        commands = self.shell.commands
+        return [name for name in self.commands.matches(text)
+                if name in commands]
+
+    def argument_index(self, name):
+        command = self.shell.commands.get(name)
+        if command is None:
+            return None
+        cached = self.arguments.get(name)
+        if cached is not None and cached[0] is command:
+            return cached[1]
+        resolve = getattr(command, 'resolve', None)
+        parser = resolve() if resolve is not None else command
+        words = []
+        for action in getattr(parser, '_actions', ()):
+            words.extend(action.option_strings)
+            if action.choices is not None:
+                words.extend(str(choice) for choice in action.choices)
+        index = PrefixIndex(words)
+        # Building a lazy command replaces it in shell.commands.
+        self.arguments[name] = (self.shell.commands.get(name), index)
+        return index
+
+    def variable_matches(self, text):
+        environment = self.shell.environment
+        versions = []
+        scope = environment
+        while scope is not None:
+            versions.append(scope.version())
+            scope = scope.parent
+        key = (environment, tuple(versions))
+        if self.variables is None or self.variables[0] != key:
+            self.variables = (key, PrefixIndex(environment))
+        return ['{' + name + '}'
+                for name in self.variables[1].matches(text[1:])]
+
+    def path_matches(self, text):
+        directory, prefix = os.path.split(text)
+        listing = self.directories.listing(
+            os.path.expanduser(directory) or os.curdir)
+        if not prefix.startswith('.'):
+            names = [name for name in listing.matches(prefix)
+                     if not name.startswith('.')]
+        else:
+            names = listing.matches(prefix)
+        return [os.path.join(directory, name) for name in names]
+
+    def complete(self, line, begin, text):
+        """
+        Returns the completions of text, the word starting at begin in
+        line.
+        """
+        start = max(line.rfind(separator, 0, begin)
+                    for separator in self.separators) + 1
+        words = line[start:begin].split()
+        if text.startswith('{'):
+            return self.variable_matches(text)
+        if not words:
+            return self.command_matches(text) or self.path_matches(text)
+        matches = []
+        if os.sep not in text:
+            index = self.argument_index(words[0])
+            if index is not None:
+                matches = index.matches(text)
+        return matches or self.path_matches(text)
@@ -0,0 +1,468 @@
+import re
+
+from .parser import ParseError, BACKGROUND, KEYWORDS, PIPE
+
+# $1, $2 ... for arguments, $0 for the name and $@ for all of them as
+# separate words.  There is no $#, since # starts a comment.
+POSITIONAL = re.compile(r'\$(\d+|@)')
+SPECIAL = ' \t\n;|&#"\'\\'
+
+
+class ALL:
+    """
+    Stands for a word that is exactly $@.
+    """
+
+
+class SEPARATOR:
+    """
+    Ends each statement in the tokens handed to the block parser.
+    """
+
+
+def compile_word(word):
+    """
+    Returns word unchanged if it has no positional references, ALL if it is
+    $@, or a tuple alternating literal text and references.
+
+    >>> compile_word('plain')
+    'plain'
+    >>> compile_word('file$1.txt')
+    ('file', '1', '.txt')
+    """
+    if not isinstance(word, str) or '$' not in word:
+        return word
+    if word == '$@':
+        return ALL
+    parts = POSITIONAL.split(word)
+    if len(parts) == 1:
+        return word
+    return tuple(parts)
+
+
+def compile_words(words):
+    """
+    Returns the compiled words, or None if none refer to arguments.
+    """
+    compiled = [compile_word(word) for word in words]
+    if all(word is original for word, original in zip(compiled, words)):
+        return None
+    return compiled
+
+
+def substitute(words, compiled, arguments):
+    """
+    The words with references replaced by arguments, whose first item is
+    the name of the function.
+    """
+    if compiled is None or arguments is None:
+        return words
+    result = []
+    for word in compiled:
+        if word is ALL:
+            result.extend(arguments[1:])
+        elif isinstance(word, tuple):
+            result.append(''.join(
+                part if index % 2 == 0 else
+                arguments[int(part)] if int(part) < len(arguments) else ''
+                for index, part in enumerate(word)))
+        else:
+            result.append(word)
+    return result
+
+
+def describe(words):
+    """
+    Writes words back out as text that parses to them again.
+    """
+    text = []
+    for word in words:
+        if word is PIPE:
+            text.append('|')
+        elif word is BACKGROUND:
+            text.append('&')
+        elif word is SEPARATOR:
+            text.append(';')
+        elif not word or any(character in word for character in SPECIAL):
+            text.append('"{}"'.format(
+                word.replace('\\', '\\\\').replace('"', '\\"')))
+        else:
+            text.append(word)
+    return ' '.join(text)
+
+
+class Frame:
+    """
+    The state of one run of a block: the arguments it substitutes, the
+    environment its commands expand their arguments with, and its status,
+    which is the error of the last statement or None if it succeeded.  It
+    is kept apart from the shell so that a block may run in a job or in
+    parallel with others.
+    """
+    def __init__(self, arguments, environment):
+        self.arguments = arguments
+        self.environment = environment
+        self.status = None
+
+
+class Simple:
+    """
+    One statement.  Unless its command name refers to arguments, the
+    command is looked up once and reused until the shell's commands change.
+    """
+    def __init__(self, statement):
+        self.statement = list(statement)
+        self.compiled = compile_words(self.statement)
+        self.direct = (PIPE not in self.statement and
+                       BACKGROUND not in self.statement and
+                       (self.compiled is None or
+                        self.compiled[0] is self.statement[0]))
+        # (shell, command version, command), replaced as a whole since the
+        # node may run in several threads.
+        self.resolved = (None, None, None)
+
+    def run(self, shell, frame):
+        statement = substitute(self.statement, self.compiled, frame.arguments)
+        environment = frame.environment
+        try:
+            if not self.direct:
+                self.run_indirect(shell, statement, environment)
+                frame.status = None
+                return
+            resolved_shell, version, instance = self.resolved
+            if resolved_shell is not shell or version != shell.command_version:
+                version = shell.command_version
+                instance = shell.commands.get(statement[0])
+                self.resolved = (shell, version, instance)
+            if instance is None:
+                shell.dispatch(statement[0], statement[1:], True, environment)
+            else:
+                shell.call_resolved(
+                    instance, statement[0], statement[1:], environment)
+        except Exception as error:
+            frame.status = error
+        else:
+            frame.status = None
+
+    def run_indirect(self, shell, statement, environment):
+        if statement[-1] is BACKGROUND:
+            job = shell.scheduler.submit(statement[:-1], environment)
+            print('[{}]'.format(job.id))
+        else:
+            shell.call_statement(statement, environment=environment)
+
+
+def run_block(shell, nodes, frame):
+    for node in nodes:
+        node.run(shell, frame)
+
+
+class Condition:
+    """
+    A statement whose success decides a branch or loop.  A leading !
+    inverts it.
+    """
+    def __init__(self, words):
+        self.negate = bool(words) and words[0] == '!'
+        if self.negate:
+            words = words[1:]
+        if not words:
+            raise ParseError('Missing condition')
+        self.node = Simple(words)
+
+    def test(self, shell, frame):
+        self.node.run(shell, frame)
+        return (frame.status is None) != self.negate
+
+
+class If:
+    def __init__(self, condition, body, orelse):
+        self.condition = condition
+        self.body = body
+        self.orelse = orelse
+
+    def run(self, shell, frame):
+        branch = self.body if self.condition.test(shell, frame) else self.orelse
+        frame.status = None
+        run_block(shell, branch, frame)
+
+
+class While:
+    def __init__(self, condition, body):
+        self.condition = condition
+        self.body = body
+
+    def run(self, shell, frame):
+        status = None
+        while self.condition.test(shell, frame):
+            frame.status = None
+            run_block(shell, self.body, frame)
+            status = frame.status
+        frame.status = status
+
+
+class For:
+    """
+    Runs its body once per word, with the word in a variable of a new
+    scope, which jobs started by the body keep.
+    """
+    def __init__(self, name, words, body):
+        self.name = name
+        self.words = words
+        self.compiled = compile_words(words)
+        self.body = body
+
+    def run(self, shell, frame):
+        words = substitute(self.words, self.compiled, frame.arguments)
+        environment = frame.environment
+        try:
+            frame.status = None
+            for word in words:
+                frame.environment = environment.child(**{self.name: word})
+                run_block(shell, self.body, frame)
+        finally:
+            frame.environment = environment
+
+
+class Define:
+    """
+    Registers a function when run.
+    """
+    def __init__(self, name, body, text):
+        self.name = name
+        self.body = body
+        self.text = text
+
+    def run(self, shell, frame):
+        from .functions import Function
+        shell.set_command(
+            self.name, Function(shell, self.name, self.body, self.text))
+        frame.status = None
+
+
+class Tokens:
+    def __init__(self, statements):
+        self.items = []
+        for statement in statements:
+            self.items.extend(statement)
+            self.items.append(SEPARATOR)
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.items):
+            return self.items[self.position]
+        return None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise ParseError('Missing }')
+        self.position += 1
+        return token
+
+    def expect(self, word):
+        token = self.next()
+        if token != word:
+            raise ParseError('Expected {!r}, found {!r}'.format(
+                word, describe([token])))
+
+    def header(self):
+        """
+        The words up to an opening brace, which is consumed.
+        """
+        words = []
+        while True:
+            token = self.next()
+            if token == '{':
+                return words
+            if token is SEPARATOR:
+                raise ParseError('Expected {')
+            words.append(token)
+
+
+def parse_block(tokens, closed):
+    """
+    Parses statements up to a closing brace if closed is true, or else to
+    the end of tokens, into a list of nodes.
+    """
+    nodes = []
+    words = []
+    while True:
+        token = tokens.peek()
+        if token is None:
+            if closed:
+                raise ParseError('Missing }')
+            break
+        tokens.position += 1
+        if token is SEPARATOR or token == '}':
+            if words:
+                nodes.append(Simple(words))
+                words = []
+            if token == '}':
+                if not closed:
+                    raise ParseError('Unexpected }')
+                return nodes
+        elif not words and token in KEYWORDS:
+            nodes.append(PARSERS[token](tokens))
+        else:
+            words.append(token)
+    if words:
+        nodes.append(Simple(words))
+    return nodes
+
+
+def parse_if(tokens):
+    condition = Condition(tokens.header())
+    body = parse_block(tokens, True)
+    orelse = []
+    if tokens.peek() == 'else':
+        tokens.next()
+        if tokens.peek() == 'if':
+            tokens.next()
+            orelse = [parse_if(tokens)]
+        else:
+            tokens.expect('{')
+            orelse = parse_block(tokens, True)
+    return If(condition, body, orelse)
+
+
+def parse_while(tokens):
+    condition = Condition(tokens.header())
+    return While(condition, parse_block(tokens, True))
+
+
+def parse_for(tokens):
+    header = tokens.header()
+    if len(header) < 2 or header[1] != 'in':
+        raise ParseError('Expected: for NAME in WORDS { STATEMENTS }')
+    return For(header[0], header[2:], parse_block(tokens, True))
+
+
+def parse_function(tokens):
+    header = tokens.header()
+    if len(header) != 1:
+        raise ParseError('Expected: function NAME { STATEMENTS }')
+    start = tokens.position
+    body = parse_block(tokens, True)
+    lines = []
+    line = []
+    for token in tokens.items[start:tokens.position - 1] + [SEPARATOR]:
+        if token is not SEPARATOR:
+            line.append(token)
+        elif line:
+            lines.append('    ' + describe(line))
+            line = []
+    return Define(header[0], body, '\n'.join(lines))
+
+
+PARSERS = dict(
+    (keyword, globals()['parse_' + keyword]) for keyword in KEYWORDS)
+
+
+def parse(statements):
+    """
+    Compiles statements, which may contain if, for, while and function
+    constructs, into nodes run by run_block.
+    """
+    return parse_block(Tokens(statements), False)
+
+
+class Construct:
+    """
+    Collects the statements of a construct as they arrive, until its
+    braces balance.  An else must follow the closing brace on the same
+    line.
+    """
+    def __init__(self, statement):
+        self.statements = []
+        self.depth = 0
+        self.complete = False
+        self.add(statement)
+
+    def add(self, statement):
+        self.statements.append(statement)
+        for word in statement:
+            if word == '{':
+                self.depth += 1
+            elif word == '}':
+                self.depth -= 1
+        self.complete = self.depth <= 0
+
+    def run(self, shell):
+        frame = Frame(None, shell.environment)
+        run_block(shell, parse(self.statements), frame)
+        shell.last_error = frame.status
+
+
+if __name__ == '__main__':
+    import doctest
+    import io
+    import sys
+
+    from . import Shell
+    from .command import IntList
+
+    doctest.testmod()
+
+    shell = Shell(stdout=io.StringIO())
+    calls = []
+
+    @shell.add_command
+    def ok():
+        pass
+
+    @shell.add_command
+    def fail():
+        raise ValueError('failed')
+
+    @shell.add_command
+    def ints(values:IntList(0)):
+        pass
+
+    @shell.add_command
+    def below(limit):
+        # Succeeds the first limit times it is called.
+        calls.append(limit)
+        if len(calls) > int(limit):
+            raise ValueError('done')
+
+    def test(line, expected, failed=False):
+        del calls[:]
+        stderr, sys.stderr = sys.stderr, io.StringIO()
+        try:
+            with shell.capture() as captured:
+                shell.send_command(line)
+        finally:
+            sys.stderr = stderr
+        got = captured.getvalue().split()
+        if got != expected or (shell.last_error is not None) != failed:
+            print('*' * 40)
+            print('Running {!r}:'.format(line))
+            print('\tExpected: {!r}{}'.format(
+                expected, ' and an error' if failed else ''))
+            print('\tGot: {!r} and {!r}'.format(got, shell.last_error))
+
+    test('if ok { echo yes } else { echo no }', ['yes'])
+    test('if fail { echo yes } else { echo no }', ['no'])
+    test('if ! fail { echo yes }', ['yes'])
+    test('if ! ok { echo yes }', [])
+    test('if nosuch { echo yes } else { echo no }',
+         ['No', 'such', 'command:', "'nosuch'", 'no'])
+    test('if ints x { echo yes } else { echo no }', ['no'])
+    test('if ints 1 2 { echo yes } else { echo no }', ['yes'])
+    test('if fail { echo 1 } else if ok { echo 2 } else { echo 3 }', ['2'])
+    test('if fail { echo 1 } else if fail { echo 2 } else { echo 3 }', ['3'])
+    test('while below 3 { echo x }', ['x', 'x', 'x'])
+    test('while below 0 { echo x }', [])
+    test('while below 1 { fail }', [], failed=True)
+    test('for word in a b { echo {word} }', ['a', 'b'])
+    test('for word in { echo {word} }', [])
+    test('for word in a b { fail }', [], failed=True)
+    test('echo {word}', [], failed=True)
+    test('function each { for word in $@ { echo {word} } }', [])
+    test('each c d', ['c', 'd'])
+    test('echo {word}', [], failed=True)
+    test('function check { if $1 { echo yes } else { fail } }', [])
+    test('check ok', ['yes'])
+    test('check fail', [], failed=True)
+    test('nosuch', ['No', 'such', 'command:', "'nosuch'"], failed=True)
@@ -1,5 +1,6 @@
 
-import collections
+import collections.abc
+import time
 
 
 class LookupError(Exception):
@@ -43,6 +44,10 @@ class NO_DEFAULT:
     pass
 
 
+class DELETED:
+    pass
+
+
 class ItemLookup(Lookup):
     def __init__(self, obj, item, default=NO_DEFAULT,
                  set_allowed=True, delete_allowed=True):
@@ -99,7 +104,142 @@ class AttributeLookup(Lookup):
             raise DeleteForbidden
 
 
-class Environment(collections.MutableMapping):
+class Version:
+    """
+    A counter that is bumped whenever whatever it tracks changes.
+    """
+    def __init__(self):
+        self.value = 0
+
+    def bump(self):
+        self.value += 1
+
+    def __call__(self):
+        return self.value
+
+
+class CachedLookup(Lookup):
+    """
+    Caches the value of another Lookup, or of a getter function, until
+    invalidate() is called.  Writes and deletes go to the source and
+    invalidate the cache.
+
+    >>> calls = []
+    >>> def expensive():
+    ...   calls.append(None)
+    ...   return len(calls)
+
+    >>> lookup = CachedLookup(expensive)
+    >>> lookup.__get__(), lookup.__get__()
+    (1, 1)
+    >>> lookup.invalidate()
+    >>> lookup.__get__()
+    2
+    >>> lookup.hits, lookup.misses
+    (1, 2)
+    """
+    def __init__(self, source):
+        if not isinstance(source, Lookup):
+            source = Lookup(source)
+        self.source = source
+        self.value = None
+        self.valid = False
+        self.hits = 0
+        self.misses = 0
+
+    def is_valid(self):
+        return self.valid
+
+    def invalidate(self):
+        self.valid = False
+        self.value = None
+
+    def refresh(self):
+        self.value = self.source.__get__()
+        self.valid = True
+
+    def __get__(self):
+        if self.is_valid():
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.refresh()
+        return self.value
+
+    def __set__(self, new):
+        self.source.__set__(new)
+        self.invalidate()
+
+    def __delete__(self):
+        self.source.__delete__()
+        self.invalidate()
+
+
+MemoizedLookup = CachedLookup
+
+
+class TTLLookup(CachedLookup):
+    """
+    Caches the value of source for ttl seconds.
+
+    >>> now = [0]
+    >>> lookup = TTLLookup(lambda: now[0], 5, clock=lambda: now[0])
+    >>> lookup.__get__()
+    0
+    >>> now[0] = 4
+    >>> lookup.__get__()
+    0
+    >>> now[0] = 5
+    >>> lookup.__get__()
+    5
+    """
+    def __init__(self, source, ttl, clock=time.monotonic):
+        super().__init__(source)
+        self.ttl = ttl
+        self.clock = clock
+        self.expires = None
+
+    def is_valid(self):
+        return self.valid and self.clock() < self.expires
+
+    def refresh(self):
+        super().refresh()
+        self.expires = self.clock() + self.ttl
+
+
+class VersionedLookup(CachedLookup):
+    """
+    Caches the value of source for as long as every one of versions, each
+    a callable such as a Version or Environment.version, returns what it
+    did when the value was computed.
+
+    >>> version = Version()
+    >>> calls = []
+    >>> lookup = VersionedLookup(lambda: calls.append(None) or len(calls),
+    ...                          version)
+    >>> lookup.__get__(), lookup.__get__()
+    (1, 1)
+    >>> version.bump()
+    >>> lookup.__get__()
+    2
+    """
+    def __init__(self, source, *versions):
+        super().__init__(source)
+        self.versions = versions
+        self.seen = None
+
+    def current(self):
+        return tuple(version() for version in self.versions)
+
+    def is_valid(self):
+        return self.valid and self.seen == self.current()
+
+    def refresh(self):
+        self.seen = self.current()
+        super().refresh()
+
+
+class Environment(collections.abc.MutableMapping):
     """
 
     >>> source_list = [1, 2, 3]
@@ -167,19 +307,85 @@ class Environment(collections.MutableMapping):
     Traceback (most recent call last):
      ...
     WriteForbidden
+
+    Lookups can be cached against the environment's own version, which
+    changes whenever a variable is set or deleted.
+
+    >>> env['home'] = '/home/user'
+    >>> env['cached'] = VersionedLookup(lambda: env['home'] + '/x',
+    ...                                 env.version)
+    >>> env['cached'], env['cached']
+    ('/home/user/x', '/home/user/x')
+    >>> env['home'] = '/root'
+    >>> env['cached']
+    '/root/x'
+    >>> env.cache_stats()
+    {'cached': {'hits': 1, 'misses': 2}}
     """
     def __init__(self, **namespace):
         self.namespace = dict()
+        self.parent = None
+        self.exported = set()
+        self.version = Version()
         self.namespace.update(namespace)
 
+    def child(self, **namespace):
+        """
+        Returns a new scope on top of this one.  Reads fall through to this
+        environment; writes and deletes stay in the child unless the
+        variable has been exported from it.  Creating a scope copies
+        nothing, and discarding it discards its variables.
+
+        >>> outer = Environment(a=1, b=ItemLookup({'b': 2}, 'b'))
+        >>> inner = outer.child(c=3)
+        >>> inner['a'], inner['b'], inner['c']
+        (1, 2, 3)
+        >>> inner['b'] = 20
+        >>> del inner['a']
+        >>> inner.export('d')
+        >>> inner['d'] = 4
+        >>> sorted(inner.items())
+        [('b', 20), ('c', 3), ('d', 4)]
+        >>> sorted(outer.items())
+        [('a', 1), ('b', 2), ('d', 4)]
+        """
+        scope = self.__class__()
+        scope.parent = self
+        scope.namespace.update(namespace)
+        return scope
+
+    def export(self, *keys):
+        """
+        Send writes to keys through to the parent scope, moving any value
+        already set in this scope there.
+        """
+        for key in keys:
+            self.exported.add(key)
+            if self.parent is not None and key in self.namespace:
+                value = self.namespace.pop(key)
+                if value is not DELETED:
+                    self.parent[key] = value
+
     def __getitem__(self, key):
-        value = self.namespace[key]
+        scope = self
+        while True:
+            try:
+                value = scope.namespace[key]
+                break
+            except KeyError:
+                scope = scope.parent
+                if scope is None:
+                    raise KeyError(key)
         if isinstance(value, Lookup):
             return value.__get__()
+        if value is DELETED:
+            raise KeyError(key)
         return value
 
     def __setitem__(self, key, value):
-        if isinstance(value, Lookup):
+        if self.parent is not None and key in self.exported:
+            self.parent[key] = value
+        elif isinstance(value, Lookup):
             self.namespace[key] = value
         else:
             lookup = self.namespace.get(key)
@@ -187,19 +393,68 @@ class Environment(collections.MutableMapping):
                 lookup.__set__(value)
             else:
                 self.namespace[key] = value
+        self.version.bump()
 
     def __delitem__(self, key):
         lookup = self.namespace.get(key)
-        if isinstance(lookup, Lookup):
+        if self.parent is not None and key in self.exported:
+            del self.parent[key]
+        elif isinstance(lookup, Lookup):
             lookup.__delete__()
-        else:
+        elif self.parent is None:
             del self.namespace[key]
+        elif key in self:
+            # Hide the variable from this scope without touching parents.
+            self.namespace[key] = DELETED
+        else:
+            raise KeyError(key)
+        self.version.bump()
+
+    def cache_stats(self):
+        """
+        Hit and miss counts for every CachedLookup in the namespace.
+        """
+        return dict(
+            (key, dict(hits=value.hits, misses=value.misses))
+            for key, value in self.namespace.items()
+            if isinstance(value, CachedLookup))
+
+    def invalidate(self):
+        """
+        Drop the cached values of every CachedLookup in the namespace.
+        """
+        for value in self.namespace.values():
+            if isinstance(value, CachedLookup):
+                value.invalidate()
+
+    def __contains__(self, key):
+        scope = self
+        while scope is not None:
+            if key in scope.namespace:
+                return scope.namespace[key] is not DELETED
+            scope = scope.parent
+        return False
 
     def __len__(self):
-        return len(self.namespace)
+        if self.parent is None:
+            return len(self.namespace)
+        return sum(1 for _ in self)
 
     def __iter__(self):
-        return iter(self.namespace)
+        if self.parent is None:
+            return iter(self.namespace)
+        return self._iter_scopes()
+
+    def _iter_scopes(self):
+        seen = set()
+        scope = self
+        while scope is not None:
+            for key, value in scope.namespace.items():
+                if key not in seen:
+                    seen.add(key)
+                    if value is not DELETED:
+                        yield key
+            scope = scope.parent
 
 
 if __name__ == '__main__':
@@ -0,0 +1,271 @@
+
+import os
+import subprocess
+import sys
+import threading
+
+from .command import Command, List
+
+
+class ExternalError(Exception):
+    """
+    Raised when an external program exits with a non-zero status.
+    """
+    def __init__(self, name, status):
+        self.name = name
+        self.status = status
+        super().__init__('{} exited with status {}'.format(name, status))
+
+
+def is_executable(path):
+    return os.path.isfile(path) and os.access(path, os.X_OK)
+
+
+class PathCache:
+    """
+    Remembers where programs were found on PATH, like the hash table in
+    other shells.  Everything is forgotten when PATH changes.
+    """
+    def __init__(self):
+        self.paths = {}
+        self.search = None
+
+    def lookup(self, name):
+        if os.sep in name:
+            return name if is_executable(name) else None
+        search = os.environ.get('PATH', os.defpath)
+        if search != self.search:
+            self.paths.clear()
+            self.search = search
+        try:
+            return self.paths[name]
+        except KeyError:
+            pass
+        for directory in search.split(os.pathsep):
+            path = os.path.join(directory or os.curdir, name)
+            if is_executable(path):
+                self.paths[name] = path
+                return path
+        return None
+
+    def forget(self, name):
+        self.paths.pop(name, None)
+
+    def clear(self):
+        self.paths.clear()
+
+
+def spawn(path, argv, stdin=None, stdout=None):
+    """
+    Start path with the given file descriptors as its standard input and
+    output, inheriting ours where they are None.  Uses posix_spawn where
+    available.
+    """
+    if hasattr(os, 'posix_spawn'):
+        actions = []
+        if stdin is not None:
+            actions.append((os.POSIX_SPAWN_DUP2, stdin, 0))
+        if stdout is not None:
+            actions.append((os.POSIX_SPAWN_DUP2, stdout, 1))
+        return os.posix_spawn(path, argv, os.environ, file_actions=actions)
+    return subprocess.Popen(argv, executable=path, stdin=stdin,
+                            stdout=stdout)
+
+
+def wait(process):
+    if isinstance(process, int):
+        _, status = os.waitpid(process, 0)
+        return os.waitstatus_to_exitcode(status)
+    return process.wait()
+
+
+def start_group(stages, stdin=None, stdout=None):
+    """
+    Spawn each (path, argv) in stages with the output of one connected
+    directly to the input of the next.
+    """
+    processes = []
+    source = stdin
+    try:
+        for index, (path, argv) in enumerate(stages):
+            if index == len(stages) - 1:
+                following, sink = None, stdout
+            else:
+                following, sink = os.pipe()
+            try:
+                processes.append(spawn(path, argv, source, sink))
+            finally:
+                if source is not stdin:
+                    os.close(source)
+                if sink is not stdout:
+                    os.close(sink)
+            source = following
+    except BaseException:
+        for process in processes:
+            wait(process)
+        raise
+    return processes
+
+
+def finish_group(stages, processes):
+    statuses = [wait(process) for process in processes]
+    if statuses[-1]:
+        raise ExternalError(stages[-1][1][0], statuses[-1])
+
+
+def feed(records):
+    """
+    Returns the read end of a pipe and a thread that writes records to it,
+    one per line, once started.
+    """
+    source, sink = os.pipe()
+
+    def write():
+        try:
+            with open(sink, 'w') as stream:
+                for record in records:
+                    stream.write('{}\n'.format(record))
+        except BrokenPipeError:
+            pass
+
+    return source, threading.Thread(target=write, daemon=True)
+
+
+def external_records(stages, records=None):
+    """
+    Run stages and yield each line they write as a record.
+    """
+    source = writer = None
+    if records is not None:
+        source, writer = feed(records)
+    output, sink = os.pipe()
+    try:
+        processes = start_group(stages, source, sink)
+    finally:
+        os.close(sink)
+        if source is not None:
+            os.close(source)
+    if writer is not None:
+        writer.start()
+    with open(output) as stream:
+        for line in stream:
+            yield line.rstrip('\n')
+    finish_group(stages, processes)
+
+
+def run_group(stages, records=None):
+    """
+    Run stages to completion.  Their output goes straight to the file
+    descriptor behind sys.stdout, or is copied there if it has none.
+    """
+    try:
+        sys.stdout.flush()
+        descriptor = sys.stdout.fileno()
+    except (AttributeError, ValueError, OSError):
+        for line in external_records(stages, records):
+            print(line)
+        return
+    source = writer = None
+    if records is not None:
+        source, writer = feed(records)
+    try:
+        processes = start_group(
+            stages, source, None if descriptor == 1 else descriptor)
+    finally:
+        if source is not None:
+            os.close(source)
+    if writer is not None:
+        writer.start()
+    finish_group(stages, processes)
+
+
+class HashCommand(Command):
+    def __init__(self, shell):
+        super().__init__(name='hash')
+        self.cache = shell.path_cache
+        self.add_argument('-r', dest='reset', action='store_true',
+                          help='forget all remembered locations')
+
+    def run(self, names:List(0), **options):
+        """
+        Remember or list the locations of programs
+        """
+        if options.get('reset'):
+            self.cache.clear()
+        for name in names:
+            if self.cache.lookup(name) is None:
+                raise LookupError('hash: {}: not found'.format(name))
+        if not names and not options.get('reset'):
+            for name, path in sorted(self.cache.paths.items()):
+                print('{}\t{}'.format(name, path))
+
+
+if __name__ == '__main__':
+    import io
+    import tempfile
+
+    from . import Shell
+
+    shell = Shell(stdout=io.StringIO())
+
+    @shell.add_command
+    def upper():
+        for line in sys.stdin:
+            print(line.rstrip('\n').upper())
+
+    @shell.add_command
+    def count(start):
+        return iter(range(int(start), int(start) + 3))
+
+    def test(line, expected, failed=False):
+        with shell.capture() as captured:
+            shell.send_command(line)
+        got = captured.getvalue().splitlines()
+        if got != expected or (shell.last_error is not None) != failed:
+            print('*' * 40)
+            print('Running {!r}:'.format(line))
+            print('\tExpected: {!r}{}'.format(
+                expected, ' and an error' if failed else ''))
+            print('\tGot: {!r} and {!r}'.format(got, shell.last_error))
+
+    test('printf "b\\na\\n"', ['b', 'a'])
+    test('printf "b\\na\\n" | sort', ['a', 'b'])
+    test('printf "c\\nb\\na\\n" | sort | head -n 2', ['a', 'b'])
+    test('echo x | tr x y', ['y'])
+    test('count 1 | sort -r', ['3', '2', '1'])
+    test('printf "a\\nb\\n" | upper', ['A', 'B'])
+    test('printf "b\\na\\n" | sort | upper | tr A Z', ['Z', 'B'])
+    test('count 1 | cat | upper', ['1', '2', '3'])
+    test('false', [], failed=True)
+    test('false | cat', [])
+    test('echo x | false', [], failed=True)
+    test('nosuch | cat', ["No such command: 'nosuch'"], failed=True)
+
+    # With a real file descriptor behind sys.stdout the last stage
+    # writes to it directly.
+    with tempfile.TemporaryFile('w+') as stream:
+        stdout, sys.stdout = sys.stdout, stream
+        try:
+            run_group([(PathCache().lookup('sort'), ['sort'])], ['b', 'a'])
+        finally:
+            sys.stdout = stdout
+        stream.seek(0)
+        if stream.read() != 'a\nb\n':
+            print('*' * 40)
+            print('run_group to a file descriptor:')
+            stream.seek(0)
+            print('\tGot: {!r}'.format(stream.read()))
+
+    cache = PathCache()
+    path = cache.lookup('sh')
+    if path is None or cache.paths.get('sh') != path:
+        print('*' * 40)
+        print('PathCache did not remember sh: {!r}'.format(cache.paths))
+    search = os.environ.get('PATH')
+    os.environ['PATH'] = os.pathsep
+    try:
+        if cache.lookup('sh') is not None or cache.paths:
+            print('*' * 40)
+            print('PathCache kept entries after PATH changed')
+    finally:
+        os.environ['PATH'] = search
@@ -0,0 +1,97 @@
+import argparse
+
+from .command import Command
+from .control import Frame, parse, run_block
+from .parser import ParseError, BACKGROUND
+
+
+class Function:
+    """
+    A command made of statements that were parsed and compiled when it was
+    defined.  Calling it substitutes positional references into them and
+    runs them in the shell, so the parser is not involved.  It fails with
+    the error of its last statement, if that failed.
+    """
+    expand_variables = False
+    records_parameter = None
+    cpu_bound = False
+
+    def __init__(self, shell, name, body, text, alias=False):
+        self.shell = shell
+        self.name = name
+        self.body = body
+        self.text = text
+        self.alias = alias
+
+    def run(self, arguments=()):
+        frame = Frame([self.name] + [str(argument) for argument in arguments],
+                      self.shell.environment)
+        run_block(self.shell, self.body, frame)
+        if frame.status is not None:
+            raise frame.status
+
+    def bind(self, arguments):
+        return dict(arguments=list(arguments))
+
+    def __call__(self, command, arguments, records=None):
+        return self.run(arguments)
+
+    def print_help(self, file=None):
+        print(self, file=file)
+
+    def __str__(self):
+        if self.alias:
+            return 'alias {}={}'.format(self.name, self.text)
+        return 'function {} {{\n{}\n}}'.format(self.name, self.text)
+
+
+def is_alias(command):
+    return isinstance(command, Function) and command.alias
+
+
+class AliasCommand(Command):
+    def __init__(self, shell):
+        super().__init__(name='alias')
+        self.shell = shell
+        self.add_argument('-d', '--delete', action='store_true',
+                          help='remove the named aliases')
+        self.add_argument('words', nargs=argparse.REMAINDER)
+
+    def run(self, **options):
+        """
+        Define, show or remove aliases: alias NAME=COMMAND [WORDS]
+        """
+        shell = self.shell
+        words = options['words']
+        if options['delete']:
+            for name in words:
+                if not is_alias(shell.commands.get(name)):
+                    raise LookupError('No such alias: {}'.format(name))
+                shell.remove_command(name)
+            return
+        if not words:
+            for name in sorted(shell.commands):
+                if is_alias(shell.commands[name]):
+                    print(shell.commands[name])
+            return
+        name, equals, value = words[0].partition('=')
+        if not equals:
+            for name in words:
+                command = shell.commands.get(name)
+                if not is_alias(command):
+                    raise LookupError('No such alias: {}'.format(name))
+                print(command)
+            return
+        text = ' '.join([value] + words[1:])
+        from .source import parse as parse_text
+        statements = parse_text(text, shell.parser)
+        if not statements:
+            raise ParseError('Empty alias: {}'.format(name))
+        # Arguments go after the words of the last statement.
+        last = statements[-1]
+        if last[-1] is BACKGROUND:
+            last.insert(len(last) - 1, '$@')
+        else:
+            last.append('$@')
+        shell.set_command(name, Function(shell, name, parse(statements), text,
+                                         alias=True))
@@ -0,0 +1,216 @@
+import os
+import sqlite3
+
+from .command import Command
+
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+
+def trigrams(text):
+    return set(text[index:index + 3] for index in range(len(text) - 2))
+
+
+class History:
+    """
+    Command history kept in an SQLite database, so that concurrent sessions
+    can append to it safely.  Every entry is indexed by its trigrams, which
+    lets search find substrings without reading every entry.  Once the
+    history grows a quarter beyond max_entries the oldest entries are
+    dropped and the pages they used are returned to the file system.
+
+    When the database is first created, the lines of the plain-text
+    history file legacy, as written by earlier versions, are imported into
+    it.  The legacy file itself is left untouched.
+    """
+    def __init__(self, path, max_entries=10000, legacy=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.legacy = legacy
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            legacy = [] if os.path.exists(self.path) else self.read_legacy()
+            self._connection = sqlite3.connect(
+                self.path, timeout=10, isolation_level=None)
+            self._connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            if self._connection.execute(
+                    'PRAGMA auto_vacuum').fetchone()[0] != 2:
+                # Created without auto_vacuum, which only VACUUM changes.
+                self._connection.execute('VACUUM')
+            self._connection.executescript('''
+                CREATE TABLE IF NOT EXISTS entries (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    line TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS trigrams (
+                    gram TEXT NOT NULL,
+                    entry INTEGER NOT NULL,
+                    PRIMARY KEY (gram, entry)) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS trigrams_entry
+                    ON trigrams (entry);
+            ''')
+            if legacy:
+                self.extend(legacy)
+        return self._connection
+
+    def read_legacy(self):
+        if self.legacy is None:
+            return []
+        try:
+            with open(self.legacy, 'rb') as stream:
+                if stream.read(len(SQLITE_HEADER)) in (SQLITE_HEADER, b''):
+                    return []
+                stream.seek(0)
+                lines = stream.read().decode('utf-8', 'replace').splitlines()
+        except FileNotFoundError:
+            return []
+        return [line for line in lines if line.strip()]
+
+    def append(self, line):
+        self.extend([line])
+
+    def extend(self, lines):
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for line in lines:
+                entry = connection.execute(
+                    'INSERT INTO entries (line) VALUES (?)', (line,)
+                ).lastrowid
+                connection.executemany(
+                    'INSERT OR IGNORE INTO trigrams VALUES (?, ?)',
+                    ((gram, entry) for gram in trigrams(line)))
+            trimmed = self._trim(connection)
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        if trimmed:
+            # Unlike execute, executescript runs this to completion rather
+            # than freeing a single page.
+            connection.executescript('PRAGMA incremental_vacuum')
+
+    def _trim(self, connection):
+        first, last = connection.execute(
+            'SELECT MIN(id), MAX(id) FROM entries').fetchone()
+        if last is None or last - first < self.max_entries * 5 // 4:
+            return False
+        cutoff = last - self.max_entries
+        connection.execute('DELETE FROM entries WHERE id <= ?', (cutoff,))
+        connection.execute('DELETE FROM trigrams WHERE entry <= ?',
+                           (cutoff,))
+        return True
+
+    def recent(self, count):
+        """
+        Returns the last count (id, line) pairs, oldest first.
+        """
+        rows = self.connection.execute(
+            'SELECT id, line FROM entries ORDER BY id DESC LIMIT ?',
+            (count,)).fetchall()
+        rows.reverse()
+        return rows
+
+    def search(self, text, limit=20):
+        """
+        Returns up to limit (id, line) pairs containing text, newest first.
+        """
+        grams = sorted(trigrams(text))
+        if not grams:
+            return self.connection.execute(
+                'SELECT id, line FROM entries WHERE instr(line, ?) > 0 '
+                'ORDER BY id DESC LIMIT ?', (text, limit)).fetchall()
+        return self.connection.execute(
+            'SELECT id, line FROM entries WHERE id IN ('
+            ' SELECT entry FROM trigrams WHERE gram IN ({})'
+            ' GROUP BY entry HAVING COUNT(*) = ?'
+            ') AND instr(line, ?) > 0 ORDER BY id DESC LIMIT ?'.format(
+                ', '.join('?' * len(grams))),
+            grams + [len(grams), text, limit]).fetchall()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class HistoryCommand(Command):
+    def __init__(self, shell):
+        super().__init__(name='history')
+        self.shell = shell
+        self.add_argument('-n', dest='count', type=int, default=20,
+                          help='number of entries to show')
+        self.add_argument('-s', '--search', default=None,
+                          help='show entries containing SEARCH, newest '
+                               'first')
+
+    def run(self, **options):
+        """
+        Show or search command history
+        """
+        history = self.shell.history_store
+        if history is None:
+            raise LookupError('No history file configured')
+        if options.get('search') is not None:
+            entries = history.search(options['search'], options['count'])
+        else:
+            entries = history.recent(options['count'])
+        for id, line in entries:
+            print('{:6}  {}'.format(id, line))
+
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+
+    directory = tempfile.mkdtemp()
+
+    def test(description, got, expected):
+        if got != expected:
+            print('*' * 40)
+            print('{}:'.format(description))
+            print('\tExpected: {!r}'.format(expected))
+            print('\tGot: {!r}'.format(got))
+
+    def lines(entries):
+        return [line for _, line in entries]
+
+    try:
+        legacy = os.path.join(directory, 'history')
+        with open(legacy, 'w') as stream:
+            stream.write('ls -l\n\necho hello\n')
+        history = History(legacy + '.db', max_entries=8, legacy=legacy)
+        test('Imported', lines(history.recent(10)), ['ls -l', 'echo hello'])
+        with open(legacy) as stream:
+            test('Legacy file kept', stream.read(), 'ls -l\n\necho hello\n')
+        history.append('echo world')
+        history.close()
+        history = History(legacy + '.db', max_entries=8, legacy=legacy)
+        test('Imported once', lines(history.recent(10)),
+             ['ls -l', 'echo hello', 'echo world'])
+
+        test('Search', lines(history.search('echo')),
+             ['echo world', 'echo hello'])
+        test('Search limit', lines(history.search('echo', 1)),
+             ['echo world'])
+        test('Short search', lines(history.search('l')),
+             ['echo world', 'echo hello', 'ls -l'])
+        test('Substring only', lines(history.search('llo')), ['echo hello'])
+        test('Trigrams in order', lines(history.search('owor')), [])
+        test('No match', lines(history.search('nothing')), [])
+
+        history.extend('command {}'.format(n) for n in range(6))
+        test('Below the limit', len(history.recent(20)), 9)
+        history.extend('command {}'.format(n) for n in range(6, 10))
+        test('Trimmed', lines(history.recent(20)),
+             ['command {}'.format(n) for n in range(2, 10)])
+        test('Trimmed from search', lines(history.search('echo')), [])
+        test('Trigrams trimmed', history.connection.execute(
+            'SELECT COUNT(*) FROM trigrams WHERE entry NOT IN '
+            '(SELECT id FROM entries)').fetchone()[0], 0)
+        test('Search after trimming', lines(history.search('mand 9')),
+             ['command 9'])
+        history.close()
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,260 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+from .command import Command
+
+KINDS = ('before', 'after', 'error', 'parse')
+
+
+class Hooks:
+    """
+    Callbacks run around every command the shell dispatches:
+
+    before(command, arguments)
+    after(command, elapsed, result)
+    error(command, elapsed, error)
+    parse(elapsed), after the parser produces each statement
+
+    Elapsed times are in seconds.  The shell only creates a Hooks object
+    while at least one callback is registered, so unused hooks cost a
+    single attribute check per command.
+    """
+    def __init__(self):
+        for kind in KINDS:
+            setattr(self, kind, [])
+
+    def __bool__(self):
+        return any(getattr(self, kind) for kind in KINDS)
+
+    def add(self, kind, function):
+        if kind not in KINDS:
+            raise ValueError('Unknown hook: {!r}'.format(kind))
+        getattr(self, kind).append(function)
+        return function
+
+    def remove(self, kind, function):
+        getattr(self, kind).remove(function)
+
+    def call(self, function, command, arguments, *args):
+        for hook in self.before:
+            hook(command, arguments)
+        start = time.perf_counter()
+        try:
+            result = function(command, arguments, *args)
+        except Exception as error:
+            elapsed = time.perf_counter() - start
+            for hook in self.error:
+                hook(command, elapsed, error)
+            raise
+        elapsed = time.perf_counter() - start
+        for hook in self.after:
+            hook(command, elapsed, result)
+        return result
+
+    def timed(self, statements):
+        """
+        Wraps an iterator of statements, reporting the time spent producing
+        each one to the parse hooks.
+        """
+        statements = iter(statements)
+        while True:
+            start = time.perf_counter()
+            try:
+                statement = next(statements)
+            except StopIteration:
+                return
+            elapsed = time.perf_counter() - start
+            for hook in self.parse:
+                hook(elapsed)
+            yield statement
+
+
+class Histogram:
+    """
+    Counts durations in power-of-two buckets of microseconds.
+
+    >>> histogram = Histogram()
+    >>> for elapsed in (0.000001, 0.000003, 0.0000035, 0.002):
+    ...     histogram.add(elapsed)
+    >>> histogram.as_dict()['buckets']
+    {'<2us': 1, '<4us': 2, '<2048us': 1}
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.buckets = {}
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.maximum:
+            self.maximum = elapsed
+        bucket = int(elapsed * 1e6).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def as_dict(self):
+        return dict(
+            count=self.count,
+            total=self.total,
+            mean=self.total / self.count if self.count else 0.0,
+            max=self.maximum,
+            buckets={'<{}us'.format(1 << bucket): self.buckets[bucket]
+                     for bucket in sorted(self.buckets)},
+        )
+
+
+class Stats:
+    """
+    Collects call counts, latency histograms and error counts per command,
+    and the time spent parsing each statement.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.commands = {}
+        self.errors = {}
+        self.parse_times = Histogram()
+
+    def install(self, shell):
+        shell.add_hook('after', self.after)
+        shell.add_hook('error', self.error)
+        shell.add_hook('parse', self.parse)
+
+    def uninstall(self, shell):
+        shell.remove_hook('after', self.after)
+        shell.remove_hook('error', self.error)
+        shell.remove_hook('parse', self.parse)
+
+    def histogram(self, command):
+        histogram = self.commands.get(command)
+        if histogram is None:
+            histogram = self.commands[command] = Histogram()
+        return histogram
+
+    def parse(self, elapsed):
+        # reset replaces parse_times, so the hook looks it up each time.
+        self.parse_times.add(elapsed)
+
+    def after(self, command, elapsed, result):
+        self.histogram(command).add(elapsed)
+
+    def error(self, command, elapsed, error):
+        self.histogram(command).add(elapsed)
+        self.errors[command] = self.errors.get(command, 0) + 1
+
+    def as_dict(self):
+        commands = {}
+        for command, histogram in sorted(self.commands.items()):
+            commands[command] = histogram.as_dict()
+            commands[command]['errors'] = self.errors.get(command, 0)
+        return dict(commands=commands, parse=self.parse_times.as_dict())
+
+    def dump(self, stream, **kwargs):
+        kwargs.setdefault('indent', 2)
+        json.dump(self.as_dict(), stream, **kwargs)
+        stream.write('\n')
+
+
+class TimeCommand(Command):
+    def __init__(self, shell):
+        super().__init__(name='time')
+        self.shell = shell
+        self.add_argument('words', nargs=argparse.REMAINDER)
+
+    def run(self, **options):
+        """
+        Run a command and report how long it took
+        """
+        words = options['words']
+        if not words:
+            return
+        start = time.perf_counter()
+        times = os.times()
+        try:
+            self.shell.dispatch(words[0], words[1:])
+        finally:
+            elapsed = time.perf_counter() - start
+            end = os.times()
+            print('real\t{:.3f}s'.format(elapsed))
+            print('user\t{:.3f}s'.format(
+                end.user - times.user +
+                end.children_user - times.children_user))
+            print('sys\t{:.3f}s'.format(
+                end.system - times.system +
+                end.children_system - times.children_system))
+
+
+class ProfileCommand(Command):
+    def __init__(self, shell):
+        super().__init__(name='profile')
+        self.shell = shell
+        self.add_argument('-s', '--sort', default='cumulative',
+                          help='pstats sort key')
+        self.add_argument('-n', dest='count', type=int, default=20,
+                          help='number of functions to show')
+        self.add_argument('-o', '--output', default=None,
+                          help='save the profile to OUTPUT instead')
+        self.add_argument('words', nargs=argparse.REMAINDER)
+
+    def run(self, **options):
+        """
+        Run a command under cProfile and show where the time went
+        """
+        words = options['words']
+        if not words:
+            return
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.runcall(self.shell.dispatch, words[0], words[1:])
+        finally:
+            if options['output'] is not None:
+                profile.dump_stats(options['output'])
+            else:
+                import pstats
+                pstats.Stats(profile, stream=sys.stdout).sort_stats(
+                    options['sort']).print_stats(options['count'])
+
+
+class StatsCommand(Command):
+    def __init__(self, shell):
+        super().__init__(name='stats')
+        self.shell = shell
+        self.add_argument('action', nargs='?', default='show',
+                          choices=('show', 'start', 'stop', 'reset'),
+                          help='what to do with the collected statistics')
+        self.add_argument('-o', '--output', default=None,
+                          help='write the JSON to OUTPUT')
+
+    def run(self, **options):
+        """
+        Collect per-command statistics and show them as JSON
+        """
+        shell = self.shell
+        action = options['action']
+        if action == 'start':
+            shell.collect_stats()
+        elif action == 'stop':
+            if shell.stats is not None:
+                shell.stats.uninstall(shell)
+                shell.stats = None
+        elif shell.stats is None:
+            raise LookupError('Statistics are not being collected; '
+                              'use "stats start"')
+        elif action == 'reset':
+            shell.stats.reset()
+        elif options['output'] is not None:
+            with open(options['output'], 'w') as stream:
+                shell.stats.dump(stream)
+        else:
+            shell.stats.dump(sys.stdout)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
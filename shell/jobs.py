@@ -0,0 +1,276 @@
+
+import asyncio
+import concurrent.futures
+import functools
+import itertools
+import threading
+
+from .command import Command, List
+from .output import thread_output
+from .parser import PIPE
+
+
+class Job:
+    def __init__(self, id, statement, environment=None):
+        self.id = id
+        self.statement = statement
+        self.environment = environment
+        self.future = None
+        self.last_error = None
+
+    @property
+    def state(self):
+        if not self.future.done():
+            return 'running'
+        elif self.future.cancelled():
+            return 'cancelled'
+        elif self.last_error is not None:
+            return 'failed'
+        return 'done'
+
+    def __str__(self):
+        text = ' '.join('|' if word is PIPE else word
+                        for word in self.statement)
+        return '[{}] {:<9} {}'.format(self.id, self.state, text)
+
+
+class JobScheduler:
+    """
+    Runs background jobs on an asyncio event loop in a daemon thread, so
+    they proceed while the shell waits for input.  Ordinary commands run in
+    the loop's default executor; commands defined with async def run on the
+    loop itself and can be cancelled.
+    """
+    def __init__(self, shell):
+        self.shell = shell
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.loop = None
+        self.output = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                # Jobs print to the shell's output whatever the foreground
+                # is doing, which needs sys.stdout to follow each thread.
+                self.output = thread_output()
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self._serve, daemon=True,
+                                 name='shell-jobs').start()
+        return self.loop
+
+    def _serve(self):
+        # Coroutines run on this thread, so it prints to the shell too.
+        self.output.local.buffer = self.shell.output
+        self.loop.run_forever()
+
+    def run(self, awaitable):
+        """
+        Wait for awaitable on the event loop and return its result.
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self._await(awaitable), self.start())
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            future.cancel()
+            raise
+
+    async def _await(self, awaitable):
+        return await awaitable
+
+    def submit(self, statement, environment=None):
+        """
+        Run statement as a job, expanding its arguments with environment
+        if it is given, as for a job started inside a loop.
+        """
+        job = Job(next(self.ids), statement, environment)
+        job.future = asyncio.run_coroutine_threadsafe(
+            self._run(job), self.start())
+        self.jobs[job.id] = job
+        return job
+
+    async def _run(self, job):
+        loop = asyncio.get_running_loop()
+        call = loop.run_in_executor(None, functools.partial(
+            self._call, job.statement, job.environment))
+        try:
+            try:
+                result = await asyncio.shield(call)
+            except asyncio.CancelledError:
+                # The command still finishes; close any coroutine it
+                # returns rather than leave it never awaited.
+                call.add_done_callback(_close_result)
+                raise
+            if hasattr(result, '__await__'):
+                result = await result
+                self.shell.print_result(result)
+            return result
+        except Exception as error:
+            job.last_error = error
+
+    def _call(self, statement, environment):
+        with self.output.redirect(self.shell.output):
+            return self.shell.call_statement(
+                statement, wait=False, environment=environment)
+
+    def find(self, ids):
+        """
+        Returns the jobs numbered in ids, or every job if ids is empty.
+        Numbers may be written as in other shells, with a leading %.
+        """
+        if not ids:
+            return list(self.jobs.values())
+        jobs = []
+        for id in ids:
+            try:
+                jobs.append(self.jobs[int(str(id).lstrip('%'))])
+            except (KeyError, ValueError):
+                raise LookupError('No such job: {}'.format(id))
+        return jobs
+
+    def wait(self, jobs):
+        """
+        Block until jobs finish and forget them.  Raises the error of the
+        last job that failed, so it becomes the shell's last_error.
+        """
+        concurrent.futures.wait([job.future for job in jobs])
+        error = None
+        for job in jobs:
+            self.jobs.pop(job.id, None)
+            if job.last_error is not None:
+                error = job.last_error
+        if error is not None:
+            raise error
+
+    def cancel(self, jobs):
+        for job in jobs:
+            job.future.cancel()
+
+
+def _close_result(future):
+    if not future.cancelled() and future.exception() is None:
+        close = getattr(future.result(), 'close', None)
+        if close is not None and hasattr(future.result(), '__await__'):
+            close()
+
+
+class JobsCommand(Command):
+    def __init__(self, scheduler):
+        super().__init__(name='jobs')
+        self.scheduler = scheduler
+
+    def run(self):
+        """
+        List background jobs
+        """
+        for job in self.scheduler.jobs.values():
+            print(job)
+
+
+class WaitCommand(Command):
+    def __init__(self, scheduler):
+        super().__init__(name='wait')
+        self.scheduler = scheduler
+
+    def run(self, jobs:List(0)):
+        """
+        Wait for background jobs, or all of them if none are given
+        """
+        self.scheduler.wait(self.scheduler.find(jobs))
+
+
+class CancelCommand(Command):
+    def __init__(self, scheduler):
+        super().__init__(name='cancel')
+        self.scheduler = scheduler
+
+    def run(self, jobs:List(0)):
+        """
+        Cancel background jobs, or all of them if none are given
+        """
+        self.scheduler.cancel(self.scheduler.find(jobs))
+
+
+if __name__ == '__main__':
+    import io
+    import sys
+
+    from . import Shell
+    from .output import ThreadOutput
+
+    shell = Shell(stdout=io.StringIO())
+    release = threading.Event()
+
+    @shell.add_command
+    def say(word):
+        print(word)
+
+    @shell.add_command
+    def fail():
+        raise ValueError('failed')
+
+    @shell.add_command
+    def block():
+        release.wait(10)
+        print('released')
+
+    @shell.add_command
+    async def nap(seconds):
+        await asyncio.sleep(float(seconds))
+        print('woke')
+
+    @shell.add_command
+    async def letters():
+        return iter('ab')
+
+    def test(line, expected, failed=False, ordered=True):
+        with shell.capture() as captured:
+            shell.send_command(line)
+        got = captured.getvalue().splitlines()
+        if not ordered:
+            got.sort()
+        if got != expected or (shell.last_error is not None) != failed:
+            print('*' * 40)
+            print('Running {!r}:'.format(line))
+            print('\tExpected: {!r}{}'.format(
+                expected, ' and an error' if failed else ''))
+            print('\tGot: {!r} and {!r}'.format(got, shell.last_error))
+
+    stdout = sys.stdout
+    test('say x &; wait', ['[1]', 'x'], ordered=False)
+    test('fail &; wait', ['[2]'], failed=True)
+    test('wait', [])
+    test('block &; jobs', ['[3]', '[3] running   block'])
+    release.set()
+    test('wait %3', ['released'])
+    test('wait 3', [], failed=True)
+    test('nap 0 &; wait', ['[4]', 'woke'], ordered=False)
+    test('letters &; wait', ['[5]', 'a', 'b'], ordered=False)
+    test('nap 10 &', ['[6]'])
+    test('cancel %6; wait', [])
+    test('say a | say b &; wait', ['[7]', 'b'], ordered=False)
+    test('for word in a b c { echo {word} & }; wait',
+         ['[10]', '[8]', '[9]', 'a', 'b', 'c'], ordered=False)
+    if not isinstance(sys.stdout, ThreadOutput) or (
+            sys.stdout.stream is not stdout):
+        print('*' * 40)
+        print('sys.stdout is not a ThreadOutput over the original: {!r}'
+              .format(sys.stdout))
+
+    # Jobs keep printing to their shell while another shell captures its
+    # own output in the foreground.
+    other = Shell(stdout=io.StringIO())
+    release.clear()
+    shell.send_command('block &')
+    with other.capture() as captured:
+        other.send_command('echo foreground')
+        release.set()
+        shell.scheduler.wait(shell.scheduler.find([]))
+    shell.output.flush()
+    if captured.getvalue() != 'foreground\n' or not (
+            shell.output.stream.getvalue().endswith('[11]\nreleased\n')):
+        print('*' * 40)
+        print('Job output leaked: {!r} and {!r}'.format(
+            captured.getvalue(), shell.output.stream.getvalue()))
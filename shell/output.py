@@ -0,0 +1,177 @@
+
+import contextlib
+import io
+import sys
+
+
+class OutputSink(io.TextIOBase):
+    """
+    Buffers what commands print before writing it to stream.
+
+    Output is written once buffer_size characters have accumulated, or at
+    the end of every line if line_buffering is true, which by default it is
+    only when stream is a terminal.  flush() writes everything out.
+    """
+    def __init__(self, stream, buffer_size=1 << 16, line_buffering=None):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        if line_buffering is None:
+            try:
+                line_buffering = stream.isatty()
+            except (AttributeError, ValueError):
+                line_buffering = False
+        self.line_buffering = line_buffering
+        self.parts = []
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if (self.size >= self.buffer_size or
+                self.line_buffering and '\n' in text):
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.parts:
+            text = ''.join(self.parts)
+            self.parts.clear()
+            self.size = 0
+            self.stream.write(text)
+        self.stream.flush()
+
+    def fileno(self):
+        """
+        The descriptor of the underlying stream, so that external programs
+        can write to it directly once this sink has been flushed.
+        """
+        return self.stream.fileno()
+
+
+class ThreadStream(io.TextIOBase):
+    """
+    Stands in for a standard stream while several threads use it at once,
+    sending each thread to its own buffer, if it has one, instead of
+    stream.
+    """
+    def __init__(self, stream):
+        import threading
+        self.stream = stream
+        self.local = threading.local()
+
+    def target(self):
+        buffer = getattr(self.local, 'buffer', None)
+        return self.stream if buffer is None else buffer
+
+    def fileno(self):
+        return self.target().fileno()
+
+    @contextlib.contextmanager
+    def redirect(self, buffer):
+        """
+        Send the current thread to buffer within the block.
+        """
+        previous = getattr(self.local, 'buffer', None)
+        self.local.buffer = buffer
+        try:
+            yield buffer
+        finally:
+            self.local.buffer = previous
+
+
+class ThreadOutput(ThreadStream):
+    """
+    A ThreadStream for sys.stdout and sys.stderr.
+    """
+    def writable(self):
+        return True
+
+    def write(self, text):
+        return self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+
+class ThreadInput(ThreadStream):
+    """
+    A ThreadStream for sys.stdin.
+    """
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        return self.target().read(size)
+
+    def readline(self, size=-1):
+        return self.target().readline(size)
+
+    def isatty(self):
+        return self.target().isatty()
+
+
+# What each process-wide redirect_output block in progress will restore,
+# outermost first.
+_saved = []
+
+
+@contextlib.contextmanager
+def redirect_output(stream):
+    """
+    Like contextlib.redirect_stdout, except that when sys.stdout is a
+    ThreadOutput, as in a server running sessions in threads, only the
+    current thread is redirected.
+    """
+    if isinstance(sys.stdout, ThreadOutput):
+        with sys.stdout.redirect(stream):
+            yield stream
+        return
+    _saved.append(sys.stdout)
+    sys.stdout = stream
+    try:
+        yield stream
+    finally:
+        previous = _saved.pop()
+        stdout = sys.stdout
+        if isinstance(stdout, ThreadOutput) and stdout is not previous:
+            # thread_output installed it within the block; keep it.
+            stdout.local.buffer = (
+                None if previous is stdout.stream else previous)
+        else:
+            sys.stdout = previous
+
+
+def thread_output():
+    """
+    Returns sys.stdout as a ThreadOutput, installing one for good if it is
+    not one yet.  Inside redirect_output blocks, the current thread stays
+    redirected until they end.
+    """
+    stdout = sys.stdout
+    if isinstance(stdout, ThreadOutput):
+        return stdout
+    proxy = ThreadOutput(_saved[0] if _saved else stdout)
+    if stdout is not proxy.stream:
+        proxy.local.buffer = stdout
+    sys.stdout = proxy
+    return proxy
+
+
+@contextlib.contextmanager
+def redirect_input(stream):
+    """
+    Replace sys.stdin with stream within the block, or only for the
+    current thread when sys.stdin is a ThreadInput.
+    """
+    if isinstance(sys.stdin, ThreadInput):
+        with sys.stdin.redirect(stream):
+            yield stream
+        return
+    stdin, sys.stdin = sys.stdin, stream
+    try:
+        yield stream
+    finally:
+        sys.stdin = stdin
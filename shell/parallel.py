@@ -0,0 +1,236 @@
+
+import collections
+import concurrent.futures
+import contextlib
+import io
+import os
+import sys
+
+from .command import Command, LazyCommand, List, Records, UsageError
+from .output import ThreadOutput
+
+
+class ParallelError(Exception):
+    """
+    Raised after a parallel run in which some tasks failed.  errors holds
+    (arguments, exception) pairs in input order.
+    """
+    def __init__(self, errors, total):
+        self.errors = errors
+        self.total = total
+        super().__init__('{} of {} tasks failed: {}'.format(
+            len(errors), total, '; '.join(
+                '{}: {!r}'.format(' '.join(map(str, arguments)), error)
+                for arguments, error in errors)))
+
+
+def call_captured(command, values):
+    """
+    Call command.run(**values) in a worker process, returning its printed
+    output and any exception it raised.
+    """
+    output = io.StringIO()
+    error = None
+    with contextlib.redirect_stdout(output):
+        try:
+            command.run(**values)
+        except Exception as exception:
+            error = exception
+    return output.getvalue(), error
+
+
+def call_in_thread(proxy, run, values):
+    proxy.local.buffer = output = io.StringIO()
+    error = None
+    try:
+        run(**values)
+    except Exception as exception:
+        error = exception
+    finally:
+        proxy.local.buffer = None
+    return output.getvalue(), error
+
+
+def run_parallel(command, argument_sets, jobs=None, processes=None):
+    """
+    Run command once for each list of arguments in argument_sets, which
+    may be any iterable, with up to jobs tasks at a time.  Worker processes
+    are used if processes is true or, when it is None, if the command is
+    marked cpu_bound; otherwise threads are used.  Each task's output is
+    captured and printed in input order as soon as every earlier task has
+    finished.  Raises ParallelError if any task failed.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    if isinstance(command, LazyCommand):
+        command = command.resolve()
+    if processes is None:
+        processes = getattr(command, 'cpu_bound', False)
+    if processes:
+        import pickle
+        try:
+            pickle.dumps(command)
+        except Exception as error:
+            raise TypeError('{} cannot run in worker processes: {}'.format(
+                command.name, error)) from None
+    errors = []
+    total = 0
+    pending = collections.deque()
+    stdout = sys.stdout
+
+    def finish(arguments, future):
+        try:
+            output, error = future.result()
+        except Exception as exception:
+            output, error = '', exception
+        stdout.write(output)
+        if error is not None:
+            errors.append((arguments, error))
+
+    if processes:
+        executor = concurrent.futures.ProcessPoolExecutor(jobs)
+        proxy = None
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(jobs)
+        if isinstance(stdout, ThreadOutput):
+            # Already shared by server sessions; leave it in place.
+            proxy = stdout
+        else:
+            proxy = sys.stdout = ThreadOutput(stdout)
+    try:
+        with executor:
+            for arguments in argument_sets:
+                total += 1
+                try:
+                    values = command.bind(list(arguments))
+                except UsageError as error:
+                    errors.append((arguments, error))
+                    continue
+                if values is None:
+                    errors.append((arguments, ValueError(
+                        'Invalid arguments for {}'.format(command.name))))
+                    continue
+                if proxy is None:
+                    future = executor.submit(call_captured, command, values)
+                else:
+                    future = executor.submit(
+                        call_in_thread, proxy, command.run, values)
+                pending.append((arguments, future))
+                # Keep a bounded number of tasks in flight so that output
+                # is released in order without holding the whole input.
+                while len(pending) > 2 * jobs or (
+                        pending and pending[0][1].done()):
+                    finish(*pending.popleft())
+            while pending:
+                finish(*pending.popleft())
+    finally:
+        if proxy is not None and proxy is not stdout:
+            sys.stdout = stdout
+    if errors:
+        raise ParallelError(errors, total)
+
+
+class ParallelCommand(Command):
+    def __init__(self, shell):
+        super().__init__(name='parallel')
+        self.shell = shell
+        self.add_argument('-j', '--jobs', type=int, default=None,
+                          help='number of tasks to run at once')
+        pool = self.add_mutually_exclusive_group()
+        pool.add_argument('--processes', dest='processes', default=None,
+                          action='store_true',
+                          help='run tasks in worker processes')
+        pool.add_argument('--threads', dest='processes',
+                          action='store_false',
+                          help='run tasks in worker threads')
+
+    def run(self, command, words:List(0), records:Records(), **options):
+        """
+        Run a command once per argument, or per line of piped input.
+        Arguments before ::: are passed to every task.
+        """
+        if ':::' in words:
+            index = words.index(':::')
+            fixed, words = words[:index], words[index + 1:]
+        else:
+            fixed = []
+        argument_sets = [fixed + [word] for word in words]
+        argument_sets = _chain(argument_sets, (
+            fixed + (list(record) if isinstance(record, (list, tuple))
+                     else str(record).split())
+            for record in records))
+        self.shell.parallel(command, argument_sets, **options)
+
+
+def _chain(first, rest):
+    yield from first
+    yield from rest
+
+
+if __name__ == '__main__':
+    from . import Shell
+    from .command import IntList
+
+    shell = Shell(stdout=io.StringIO())
+
+    @shell.add_command
+    def square(n:IntList(1)):
+        print(n[0] ** 2)
+
+    @shell.add_command
+    def odd(n:IntList(1)):
+        if n[0] % 2 == 0:
+            raise ValueError('even')
+        print(n[0])
+
+    def define_local():
+        @shell.add_command
+        def local(n):
+            print(n)
+    define_local()
+
+    def test(line, expected, failed=False):
+        stderr, sys.stderr = sys.stderr, io.StringIO()
+        try:
+            with shell.capture() as captured:
+                shell.send_command(line)
+        finally:
+            sys.stderr = stderr
+        got = captured.getvalue().splitlines()
+        if got != expected or (shell.last_error is not None) != failed:
+            print('*' * 40)
+            print('Running {!r}:'.format(line))
+            print('\tExpected: {!r}{}'.format(
+                expected, ' and an error' if failed else ''))
+            print('\tGot: {!r} and {!r}'.format(got, shell.last_error))
+
+    numbers = ' '.join(map(str, range(1, 21)))
+    squares = [str(n ** 2) for n in range(1, 21)]
+    test('parallel echo ::: a b c', ['a', 'b', 'c'])
+    test('parallel -j 2 echo x ::: a b', ['x a', 'x b'])
+    test('parallel -j 3 square ::: ' + numbers, squares)
+    test('parallel odd ::: 1 2 3 4', ['1', '3'], failed=True)
+    test('parallel square ::: x 2', ['4'], failed=True)
+    test('parallel square', [])
+    test('printf "1\\n2\\n" | parallel square', ['1', '4'])
+    test('parallel --threads local ::: a', ['a'])
+    test('parallel --processes -j 2 square ::: ' + numbers, squares)
+    test('parallel --processes echo ::: a b', ['a', 'b'])
+    test('parallel --processes odd ::: 1 2 3', ['1', '3'], failed=True)
+    test('parallel --processes local ::: a', [], failed=True)
+    if 'cannot run in worker processes' not in str(shell.last_error):
+        print('*' * 40)
+        print('Unclear error for a local function: {!r}'.format(
+            shell.last_error))
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            run_parallel(shell.commands['odd'], [['1'], ['2'], ['4']])
+    except ParallelError as error:
+        if ([arguments for arguments, _ in error.errors] != [['2'], ['4']]
+                or error.total != 3 or output.getvalue() != '1\n'):
+            print('*' * 40)
+            print('ParallelError: {!r} of {}'.format(
+                error.errors, error.total))
+    else:
+        print('*' * 40)
+        print('run_parallel did not raise ParallelError')
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
-from collections import deque
+from collections import deque, OrderedDict
+import re
+from types import MappingProxyType
 
 
 class Singleton:
@@ -14,10 +16,18 @@ class Singleton:
 EMIT_STATEMENTS = Singleton('EMIT_STATEMENTS')
 END_STATEMENT = Singleton('END_STATEMENT')
 END_TOKEN = Singleton('END_TOKEN')
+# Signals the end of a pipeline stage, and marks that boundary in statements.
+PIPE = Singleton('PIPE')
+# Ends a statement that should run as a background job, and marks it so.
+BACKGROUND = Singleton('BACKGROUND')
 INCLUDE = Singleton('INCLUDE')
 END_CONTEXT = Singleton('END_CONTEXT')
 REFER = Singleton('REFER')
 
+# Words that start the if, for, while and function constructs of
+# shell.control, which Shell recognises without importing it.
+KEYWORDS = ('if', 'for', 'while', 'function')
+
 
 class Context:
     def __init__(self, directives):
@@ -26,6 +36,21 @@ class Context:
             for key, value in directives.items())
         self.directives.setdefault(None, [INCLUDE])
 
+    def freeze(self):
+        """
+        Make this context and every context it refers to immutable, so
+        that it can be shared between parsers.  Returns self.
+        """
+        if isinstance(self.directives, MappingProxyType):
+            return self
+        self.directives = MappingProxyType(dict(
+            (key, tuple(value)) for key, value in self.directives.items()))
+        for directives in self.directives.values():
+            for directive in directives:
+                if isinstance(directive, Context):
+                    directive.freeze()
+        return self
+
 
 class Comment(Context):
     def __init__(self, final, refer=False):
@@ -79,28 +104,272 @@ class GeneralContext(Context):
             }),
             '\n': EMIT_STATEMENTS,
             ';': EMIT_STATEMENTS,
+            '|': PIPE,
+            '&': BACKGROUND,
         })
 
 
+TEXT = Singleton('TEXT')
+CHARACTER = Singleton('CHARACTER')
+PUSH = Singleton('PUSH')
+POP = Singleton('POP')
+RAISE = Singleton('RAISE')
+SIGNAL = Singleton('SIGNAL')
+
+SIGNALS = (END_TOKEN, END_STATEMENT, EMIT_STATEMENTS, PIPE, BACKGROUND)
+# A & that would end an empty statement, looked for after another &.
+AMPERSAND = re.compile('[ \t]*&')
+
+
+class CompiledContext:
+    """
+    State-transition table built from a Context.
+
+    Every directive list is flattened into a tuple of (operation, argument)
+    pairs, and characters that fall through to a default made only of text
+    are matched in runs by a single regular expression.
+    """
+    def __init__(self, context):
+        self.context = context
+        self.table = {}
+        self.signals = {}
+        self.default = ()
+        self.run = None
+        self.copy = False
+        self.fill = ''
+
+
+def _compile_directives(directives, character, compiled):
+    operations = []
+    for directive in directives:
+        if isinstance(directive, str):
+            operations.append((TEXT, directive))
+        elif isinstance(directive, Context):
+            operations.append((PUSH, _compile_context(directive, compiled)))
+        elif directive is END_CONTEXT:
+            operations.append((POP, None))
+        elif directive is INCLUDE:
+            if character is None:
+                operations.append((CHARACTER, None))
+            else:
+                operations.append((TEXT, character))
+        elif directive is REFER:
+            operations.append((REFER, None))
+        elif isinstance(directive, Exception):
+            operations.append((RAISE, directive))
+        elif directive in SIGNALS:
+            operations.append((SIGNAL, directive))
+    merged = []
+    for operation in operations:
+        if (operation[0] is TEXT and merged and merged[-1][0] is TEXT):
+            merged[-1] = (TEXT, merged[-1][1] + operation[1])
+        elif not (operation[0] is TEXT and not operation[1]):
+            merged.append(operation)
+    return tuple(merged)
+
+
+def _compile_context(context, compiled):
+    try:
+        return compiled[id(context)]
+    except KeyError:
+        pass
+    state = compiled[id(context)] = CompiledContext(context)
+    special = []
+    for key, directives in context.directives.items():
+        if key is None:
+            state.default = _compile_directives(directives, None, compiled)
+        elif len(key) == 1:
+            special.append(key)
+            operations = _compile_directives(directives, key, compiled)
+            state.table[key] = operations
+            if len(operations) == 1 and operations[0][0] is SIGNAL:
+                state.signals[key] = operations[0][1]
+    if state.default == ((CHARACTER, None),):
+        state.copy = True
+    elif all(operation is TEXT for operation, _ in state.default):
+        state.fill = ''.join(argument for _, argument in state.default)
+    else:
+        return state
+    if special:
+        pattern = '[^{}]+'.format(''.join(re.escape(key) for key in special))
+    else:
+        pattern = '.+'
+    state.run = re.compile(pattern, re.DOTALL).match
+    return state
+
+
+def compile_context(context):
+    """
+    Returns the CompiledContext for context and every context reachable
+    from it.
+    """
+    return _compile_context(context, {})
+
+
+class Grammar:
+    """
+    A frozen root Context together with its compiled transition tables.
+    """
+    def __init__(self, context):
+        self.context = context.freeze()
+        self.compiled = compile_context(self.context)
+        self._version = None
+
+    @property
+    def version(self):
+        """
+        A digest of every directive in the grammar, which changes whenever
+        the grammar does.  Caches of parsed statements are keyed on it.
+        """
+        if self._version is None:
+            import hashlib
+            parts = []
+            _describe(self.context, {}, parts)
+            self._version = hashlib.sha1(
+                '\n'.join(parts).encode('utf-8')).digest()
+        return self._version
+
+
+def _describe(context, seen, parts):
+    seen[id(context)] = len(seen)
+    parts.append('{}#{}'.format(type(context).__name__, seen[id(context)]))
+    for key in sorted(context.directives, key=repr):
+        described = []
+        for directive in context.directives[key]:
+            if isinstance(directive, Context):
+                if id(directive) not in seen:
+                    _describe(directive, seen, parts)
+                described.append('#{}'.format(seen[id(directive)]))
+            else:
+                described.append(repr(directive))
+        parts.append('{!r}: {}'.format(key, ' '.join(described)))
+
+
+grammars = {}
+
+
+def get_grammar(context=GeneralContext):
+    """
+    Returns the shared Grammar for a root Context class, Context instance or
+    Grammar.  Grammars for classes are built once per process.
+    """
+    if isinstance(context, Grammar):
+        return context
+    if isinstance(context, Context):
+        return Grammar(context)
+    try:
+        return grammars[context]
+    except KeyError:
+        grammar = grammars[context] = Grammar(context())
+        return grammar
+
+
+class ParseError(Exception):
+    pass
+
+
 class Parser:
-    def __init__(self):
-        self.token = ''
-        self.buffer = ''
-        self.statement = []
-        self.statements = []
+    def __init__(self, compiled=True, max_token_size=None,
+                 max_statement_size=None, grammar=GeneralContext):
+        self.grammar = get_grammar(grammar)
+        self.chunks = deque()
+        self.epoch = 0
         self.newline = '\n'
-        self.context_stack = deque()
-        self.context_stack.append(GeneralContext())
+        self.compiled = compiled
+        self.max_token_size = max_token_size
+        self.max_statement_size = max_statement_size
+        self.reset()
 
     @property
     def context(self):
+        if self.compiled:
+            return self.state_stack[-1].context
         return self.context_stack[-1]
 
+    @property
+    def token(self):
+        """
+        The token being accumulated.  Reading it joins the pending parts.
+        """
+        if len(self.parts) > 1:
+            self.parts[:] = [''.join(self.parts)]
+        return self.parts[0] if self.parts else ''
+
+    @token.setter
+    def token(self, value):
+        self.parts = [value] if value else []
+        self.token_size = len(value)
+
+    @property
+    def buffer(self):
+        """
+        Input that has been sent but not yet parsed.
+        """
+        if not self.chunks:
+            return ''
+        pending = ''.join(self.chunks)[self.position:]
+        self.epoch += 1
+        self.chunks.clear()
+        self.position = 0
+        if pending:
+            self.chunks.append(pending)
+        return pending
+
+    @buffer.setter
+    def buffer(self, value):
+        self.epoch += 1
+        self.chunks.clear()
+        self.position = 0
+        if value:
+            self.chunks.append(value)
+
     def send_line(self, line):
-        self.buffer = self.buffer + line.rstrip('\r\n') + self.newline
+        self.chunks.append(line.rstrip('\r\n') + self.newline)
+
+    def send(self, text):
+        """
+        Queue a block of input verbatim.  Line endings inside text must
+        already be normalized to newline.
+        """
+        if text:
+            self.chunks.append(text)
 
     def is_complete(self):
-        return not (self.token or self.statement or self.statements)
+        if self.compiled:
+            depth = len(self.state_stack)
+        else:
+            depth = len(self.context_stack)
+        return not (self.parts or self.statement or self.statements or
+                    depth > 1)
+
+    def reset(self):
+        """
+        Drop all pending input and partially parsed statements.  The
+        grammar is shared, so nothing is rebuilt.
+        """
+        self.parts = []
+        self.token_size = 0
+        self.epoch += 1
+        self.chunks.clear()
+        self.position = 0
+        self.statement = []
+        self.statement_size = 0
+        self.statements = []
+        self.context_stack = deque([self.grammar.context])
+        self.state_stack = deque([self.grammar.compiled])
+
+    def _check_size(self):
+        if (self.max_token_size is not None and
+                self.token_size > self.max_token_size):
+            self.reset()
+            raise ParseError('Token exceeds {} characters'.format(
+                self.max_token_size))
+        if (self.max_statement_size is not None and
+                self.token_size + self.statement_size >
+                self.max_statement_size):
+            self.reset()
+            raise ParseError('Statement exceeds {} characters'.format(
+                self.max_statement_size))
 
     def _handle_character(self, character):
         directives = self.context.directives[
@@ -126,49 +395,225 @@ class Parser:
                     return result
             elif isinstance(directive, Exception):
                 raise directive
-            elif directive in (END_TOKEN, END_STATEMENT, EMIT_STATEMENTS):
+            elif directive in SIGNALS:
                 # print(directive)
                 return directive
 
+    def _transition(self, stack, character):
+        state = stack[-1]
+        operations = state.table.get(character, state.default)
+        for operation, argument in operations:
+            if operation is TEXT:
+                self.parts.append(argument)
+                self.token_size += len(argument)
+            elif operation is CHARACTER:
+                self.parts.append(character)
+                self.token_size += 1
+            elif operation is PUSH:
+                stack.append(argument)
+            elif operation is POP:
+                stack.pop()
+            elif operation is REFER:
+                stack.pop()
+                result = self._transition(stack, character)
+                if result is not None:
+                    return result
+            elif operation is RAISE:
+                raise argument
+            else:
+                return argument
+
+    def _empty_background(self):
+        self.reset()
+        raise ParseError('Empty statement before &')
+
+    def _emit(self, new):
+        if new is BACKGROUND and not self.parts and not self.statement:
+            self._empty_background()
+        if self.parts:
+            self.statement.append(''.join(self.parts))
+            self.statement_size += self.token_size
+            self.parts = []
+            self.token_size = 0
+        if new is PIPE:
+            self.statement.append(PIPE)
+        elif new is not END_TOKEN and self.statement:
+            if new is BACKGROUND:
+                self.statement.append(BACKGROUND)
+            self.statements.append(self.statement)
+            self.statement = []
+            self.statement_size = 0
+
+    def _iter_compiled(self):
+        limited = (self.max_token_size is not None or
+                   self.max_statement_size is not None)
+        while self.chunks:
+            stack = self.state_stack
+            epoch = self.epoch
+            chunk = self.chunks[0]
+            length = len(chunk)
+            position = self.position
+            while position < length:
+                state = stack[-1]
+                if state.run is not None:
+                    match = state.run(chunk, position)
+                    if match is not None:
+                        end = match.end()
+                        if state.copy:
+                            self.parts.append(chunk[position:end])
+                            self.token_size += end - position
+                        elif state.fill:
+                            self.parts.append(
+                                state.fill * (end - position))
+                            self.token_size += (
+                                len(state.fill) * (end - position))
+                        position = end
+                        if limited:
+                            self._check_size()
+                        continue
+                character = chunk[position]
+                position += 1
+                new = state.signals.get(character)
+                if new is None:
+                    new = self._transition(stack, character)
+                    if limited:
+                        self._check_size()
+                if new is None:
+                    continue
+                if new is not EMIT_STATEMENTS:
+                    assert len(stack) == 1
+                self._emit(new)
+                if new in (EMIT_STATEMENTS, BACKGROUND) and self.statements:
+                    # Refuse && before running anything on its left.
+                    if (new is BACKGROUND and
+                            AMPERSAND.match(chunk, position) is not None):
+                        self._empty_background()
+                    self.position = position
+                    statements, self.statements = self.statements, []
+                    for statement in statements:
+                        yield statement
+                    if self.epoch != epoch:
+                        break
+                    position = self.position
+            else:
+                self.chunks.popleft()
+                self.position = 0
+
     def __iter__(self):
+        if self.compiled:
+            return self._iter_compiled()
+        return self._iter_reference()
+
+    def _iter_reference(self):
         count = 0
-        for count, character in enumerate(self.buffer, 1):
+        buffer = self.buffer
+        for count, character in enumerate(buffer, 1):
             new = self._handle_character(character)
             if new in (END_TOKEN, END_STATEMENT):
                 assert len(self.context_stack) == 1
-            if (new in (END_TOKEN, END_STATEMENT, EMIT_STATEMENTS)
-                    and self.token):
+            if new is BACKGROUND and not (self.token or self.statement):
+                self._empty_background()
+            if new in SIGNALS and self.token:
                 self.statement.append(self.token)
                 self.token = ''
-            if new in (END_STATEMENT, EMIT_STATEMENTS) and self.statement:
+            if new is PIPE:
+                self.statement.append(PIPE)
+            if new is BACKGROUND and self.statement:
+                self.statement.append(BACKGROUND)
+            if (new in (END_STATEMENT, EMIT_STATEMENTS, BACKGROUND)
+                    and self.statement):
                 self.statements.append(self.statement)
                 self.statement = []
-            if new is EMIT_STATEMENTS and self.statements:
+            if new in (EMIT_STATEMENTS, BACKGROUND) and self.statements:
+                if (new is BACKGROUND and
+                        AMPERSAND.match(buffer, count) is not None):
+                    self._empty_background()
                 for statement in self.statements:
                     yield statement
                 self.statements = []
         self.buffer = self.buffer[count:]
 
+class StatementCache:
+    """
+    Bounded LRU mapping of complete input lines to their statements, stored
+    as tuples of tuples.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, line):
+        try:
+            statements = self.entries[line]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(line)
+        self.hits += 1
+        return statements
+
+    def put(self, line, statements):
+        self.entries[line] = statements
+        self.entries.move_to_end(line)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return dict(size=self.size, entries=len(self.entries),
+                    hits=self.hits, misses=self.misses,
+                    evictions=self.evictions)
+
+
 if __name__ == '__main__':
 
     import inspect
 
     def test_statement(statement, *expected):
+        for compiled in (False, True):
+            check_statement(statement, expected, compiled)
+        check_lines(statement, expected)
+
+    def check_lines(statement, expected):
         callingframe = inspect.getouterframes(inspect.currentframe())[-1]
         _, filename, linenumber, _, _, _ = callingframe
         parser = Parser()
+        got = []
+        for line in statement.strip('\n').split('\n'):
+            parser.send_line(line)
+            got.extend(parser)
+        if got != list(expected) or not parser.is_complete():
+            print('*' * 40)
+            print('Statement at line {} of {} (line by line):'.format(
+                linenumber, filename))
+            print('\t$', '\n\t> '.join(statement.split('\n')))
+            print('Got:')
+            print('\n'.join('\t{!r}'.format(x) for x in got))
+
+    def check_statement(statement, expected, compiled):
+        callingframe = inspect.getouterframes(inspect.currentframe())[-1]
+        _, filename, linenumber, _, _, _ = callingframe
+        parser = Parser(compiled=compiled)
+        engine = 'compiled' if compiled else 'reference'
         parser.send_line(statement.strip('\n') + '\n')
         if not parser.is_complete():
             print('*' * 40)
-            print('Incomplete statement at line {} of {}:'.format(
-                linenumber, filename))
+            print('Incomplete statement at line {} of {} ({}):'.format(
+                linenumber, filename, engine))
             print('\t$', '\n\t> '.join(statement.split('\n')))
             return
         expected = list(expected)
         got = list(parser)
         if got != expected:
             print('*' * 40)
-            print('Statement at line {} of {}:'.format(linenumber, filename))
+            print('Statement at line {} of {} ({}):'.format(
+                linenumber, filename, engine))
             print('\t$', '\n\t> '.join(statement.split('\n')))
             print('Expected:')
             print('\n'.join('\t{!r}'.format(x) for x in expected))
@@ -195,3 +640,82 @@ if __name__ == '__main__':
     test_statement(r'stub \z', ['stub', 'z'])
     test_statement(r'stub "\z"', ['stub', r'\z'])
     test_statement('stub 1\ 2 "1\ 2" ', ['stub', '1 2', r'1\ 2'])
+    test_statement('stub "a\\"b" \'c\\\' # tail', ['stub', 'a"b', 'c\\'])
+    test_statement('stub a#b', ['stub', 'a'])
+    test_statement('stub 1|stub 2 | stub "|"', ['stub', '1', PIPE, 'stub', '2',
+                                                PIPE, 'stub', '|'])
+    test_statement('stub 1 & stub 2&', ['stub', '1', BACKGROUND],
+                   ['stub', '2', BACKGROUND])
+
+    def test_limit(statement, **limits):
+        callingframe = inspect.getouterframes(inspect.currentframe())[-1]
+        _, filename, linenumber, _, _, _ = callingframe
+        parser = Parser(**limits)
+        parser.send_line(statement)
+        try:
+            list(parser)
+        except ParseError:
+            if parser.is_complete():
+                return
+        print('*' * 40)
+        print('Limit not enforced at line {} of {}:'.format(
+            linenumber, filename))
+        print('\t$', statement)
+
+    test_limit('stub "1 2 3 4 5 6', max_token_size=8)
+    test_limit('stub 123 456 789', max_statement_size=8)
+
+    def test_empty_background(statement, *before):
+        callingframe = inspect.getouterframes(inspect.currentframe())[-1]
+        _, filename, linenumber, _, _, _ = callingframe
+        for compiled in (False, True):
+            parser = Parser(compiled=compiled)
+            parser.send_line(statement)
+            got = []
+            try:
+                for parsed in parser:
+                    got.append(parsed)
+            except ParseError:
+                if got == list(before) and parser.is_complete():
+                    continue
+            print('*' * 40)
+            print('Empty statement before & at line {} of {} ({}):'.format(
+                linenumber, filename, 'compiled' if compiled else 'reference'))
+            print('\t$', statement)
+            print('Got:')
+            print('\n'.join('\t{!r}'.format(x) for x in got))
+
+    test_empty_background('true && echo x')
+    test_empty_background('true & & echo x')
+    test_empty_background('& echo x')
+    test_empty_background('true; & echo x', ['true'])
+
+    def test_reset():
+        parser = Parser()
+        parser.send_line('stub "1 2')
+        list(parser)
+        parser.reset()
+        parser.send_line('stub 3')
+        got = list(parser)
+        if (got != [['stub', '3']] or
+                parser.grammar is not Parser().grammar):
+            print('*' * 40)
+            print('Parser.reset did not restore the shared grammar:')
+            print('\t{!r}'.format(got))
+
+    test_reset()
+
+    def test_cache():
+        cache = StatementCache(2)
+        cache.put('a', (('a',),))
+        cache.put('b', (('b',),))
+        cache.get('a')
+        cache.put('c', (('c',),))
+        cache.get('b')
+        expected = dict(size=2, entries=2, hits=1, misses=1, evictions=1)
+        if cache.stats() != expected or list(cache.entries) != ['a', 'c']:
+            print('*' * 40)
+            print('StatementCache did not evict the least recently used:')
+            print('\t{!r}'.format(cache.stats()))
+
+    test_cache()
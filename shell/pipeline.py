@@ -0,0 +1,86 @@
+
+import io
+
+from .output import redirect_input, redirect_output
+from .parser import PIPE
+
+
+class PipelineError(Exception):
+    pass
+
+
+def split_stages(statement):
+    """
+    Split a statement at PIPE markers into (command, arguments) pairs.
+    """
+    stages = []
+    start = 0
+    for index, word in enumerate(statement):
+        if word is PIPE:
+            stages.append(statement[start:index])
+            start = index + 1
+    stages.append(statement[start:])
+    if not all(stages):
+        raise PipelineError('Empty command in pipeline')
+    return [(stage[0], stage[1:]) for stage in stages]
+
+
+def as_records(result):
+    """
+    Returns result if a command returned records, or None.  Commands opt
+    in by returning an iterator, such as a generator; any other return
+    value, even a list or dict, is not output.
+    """
+    if hasattr(result, '__next__'):
+        return result
+    return None
+
+
+class RecordReader(io.TextIOBase):
+    """
+    A read-only text stream that renders records one per line as they are
+    read, so that plain-text commands can consume a pipeline lazily.
+    """
+    def __init__(self, records):
+        self.records = iter(records)
+
+    def readable(self):
+        return True
+
+    def readline(self, size=-1):
+        for record in self.records:
+            return '{}\n'.format(record)
+        return ''
+
+    def read(self, size=-1):
+        return ''.join(iter(self.readline, ''))
+
+
+def text_stage(command, name, arguments, records):
+    """
+    Adapt a command that prints text into a pipeline stage.  It runs when
+    the next stage first asks for a record, reading its input from
+    sys.stdin and having each printed line passed on as a record.
+    """
+    output = io.StringIO()
+    if records is None:
+        with redirect_output(output):
+            result = command(name, arguments)
+    else:
+        with redirect_input(RecordReader(records)), redirect_output(output):
+            result = command(name, arguments)
+    yield from output.getvalue().splitlines()
+    records = as_records(result)
+    if records is not None:
+        yield from records
+
+
+def run_stage(command, name, arguments, records):
+    """
+    Returns the records produced by one stage of a pipeline.  Commands
+    with a Records parameter are chained directly; any other command goes
+    through text_stage.
+    """
+    if getattr(command, 'records_parameter', None) is not None:
+        return as_records(command(name, arguments, records))
+    return text_stage(command, name, arguments, records)
@@ -0,0 +1,143 @@
+import io
+import os
+import selectors
+import signal
+import socket
+import socketserver
+import stat
+import sys
+
+from .output import ThreadInput, ThreadOutput
+
+# The first line a client sends says how to treat its input.
+INTERACTIVE = b'tty'
+BATCH = b'pipe'
+
+
+class SessionInput(io.TextIOWrapper):
+    """
+    Text read from a client, which counts as a terminal if the client's
+    own input is one, so that the session prompts for each line.
+    """
+    interactive = False
+
+    def isatty(self):
+        return self.interactive
+
+
+class SessionHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        interactive = self.rfile.readline().strip() == INTERACTIVE
+        stdin = SessionInput(self.rfile, encoding='utf-8')
+        stdin.interactive = interactive
+        stdout = io.TextIOWrapper(self.wfile, encoding='utf-8',
+                                  write_through=True)
+        session = server.shell.session(
+            stdout, use_rawinput=False, line_buffering=interactive)
+        with server.stdout.redirect(session.output), \
+                server.stderr.redirect(session.output):
+            try:
+                session.send_stream(stdin)
+            except (SystemExit, BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                try:
+                    session.output.flush()
+                except OSError:
+                    pass
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves sessions of shell to clients connecting to a Unix socket at
+    path, each in its own thread.  Sessions share the commands registered
+    with shell but have their own parser, environment scope and output.
+
+    While the server runs, sys.stdin, sys.stdout and sys.stderr are
+    replaced by ThreadInput and ThreadOutput objects, so that every session
+    reads pipeline records and prints to its own client.
+    The socket is only accessible to the user running the server.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, shell):
+        self.shell = shell
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise FileExistsError(
+                    'Not a socket, so not replacing it: {}'.format(path))
+            try:
+                with socket.socket(socket.AF_UNIX) as probe:
+                    probe.connect(path)
+            except OSError:
+                # Left behind by a server that is no longer running.
+                os.unlink(path)
+            else:
+                raise OSError('Already serving on {}'.format(path))
+        mask = os.umask(0o177)
+        try:
+            super().__init__(path, SessionHandler)
+        finally:
+            os.umask(mask)
+
+    def serve_forever(self, poll_interval=0.5):
+        stdin, stdout, stderr = sys.stdin, sys.stdout, sys.stderr
+        self.stdin = sys.stdin = ThreadInput(stdin)
+        self.stdout = sys.stdout = ThreadOutput(stdout)
+        self.stderr = sys.stderr = ThreadOutput(stderr)
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = stdin, stdout, stderr
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+def serve(shell, path):
+    """
+    Serve sessions of shell on path until interrupted or terminated.
+    """
+    signal.signal(signal.SIGTERM, lambda number, frame: sys.exit())
+    with Server(path, shell) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def connect(path, stdin=None, stdout=None):
+    """
+    Connect a terminal or pipe to a new session of the server at path,
+    copying stdin to it and its output to stdout until it ends.
+    """
+    stdin = sys.stdin.fileno() if stdin is None else stdin
+    stdout = sys.stdout.fileno() if stdout is None else stdout
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(path)
+    connection.sendall(
+        (INTERACTIVE if os.isatty(stdin) else BATCH) + b'\n')
+    selector = selectors.DefaultSelector()
+    selector.register(stdin, selectors.EVENT_READ)
+    selector.register(connection, selectors.EVENT_READ)
+    with connection, selector:
+        while True:
+            for key, _ in selector.select():
+                if key.fileobj is connection:
+                    data = connection.recv(1 << 16)
+                    if not data:
+                        return
+                    while data:
+                        data = data[os.write(stdout, data):]
+                else:
+                    data = os.read(stdin, 1 << 16)
+                    if data:
+                        connection.sendall(data)
+                    else:
+                        selector.unregister(stdin)
+                        connection.shutdown(socket.SHUT_WR)
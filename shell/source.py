@@ -0,0 +1,271 @@
+import hashlib
+import marshal
+import os
+import struct
+import zlib
+
+from .command import Command
+from .parser import Parser, ParseError, PIPE, BACKGROUND
+
+# Bump whenever the layout below or the meaning of parsed statements
+# changes.
+MAGIC = b'SHC\x02'
+# magic, flags, source mtime in ns, source size, grammar version, source
+# digest, then the CRC32 and length of the payload that follows.
+HEADER = struct.Struct('<4sIQQ20s20sII')
+CHECK_HASH = 1
+
+MARKERS = {PIPE: 0, BACKGROUND: 1}
+UNMARKERS = {code: marker for marker, code in MARKERS.items()}
+
+
+def cache_path(path, cache_dir=None):
+    """
+    Where the statements parsed from path are cached: in a __shcache__
+    directory beside it, or under cache_dir named after its absolute path.
+    """
+    path = os.path.abspath(path)
+    if cache_dir is None:
+        directory, name = os.path.split(path)
+        return os.path.join(directory, '__shcache__', name + '.shc')
+    name = hashlib.sha1(path.encode('utf-8', 'surrogateescape')).hexdigest()
+    return os.path.join(cache_dir, name + '.shc')
+
+
+def encode(statements):
+    return marshal.dumps([
+        [word if isinstance(word, str) else MARKERS[word]
+         for word in statement]
+        for statement in statements])
+
+
+def decode(payload):
+    return [
+        [word if isinstance(word, str) else UNMARKERS[word]
+         for word in statement]
+        for statement in marshal.loads(payload)]
+
+
+def parse(text, parser):
+    """
+    Parses the whole of text with a new parser configured like parser.
+    Raises ParseError if the text ends inside a statement.
+    """
+    parser = Parser(compiled=parser.compiled,
+                    max_token_size=parser.max_token_size,
+                    max_statement_size=parser.max_statement_size,
+                    grammar=parser.grammar)
+    parser.send(text)
+    if not text.endswith('\n'):
+        parser.send('\n')
+    statements = list(parser)
+    if not parser.is_complete():
+        raise ParseError('Unexpected end of file')
+    return statements
+
+
+def read_cache(filename, stat, version, digest=None):
+    """
+    Returns the cached statements if the entry in filename matches the
+    source described by stat (or its digest, when given) and the grammar
+    version, or None if it is missing, stale or corrupt.
+    """
+    try:
+        with open(filename, 'rb') as stream:
+            data = stream.read()
+    except OSError:
+        return None
+    if len(data) < HEADER.size:
+        return None
+    (magic, flags, mtime, size, grammar, source_digest, checksum,
+     length) = HEADER.unpack_from(data)
+    if magic != MAGIC or grammar != version:
+        return None
+    if digest is not None:
+        if source_digest != digest:
+            return None
+    elif flags & CHECK_HASH or (mtime, size) != (stat.st_mtime_ns,
+                                                 stat.st_size):
+        return None
+    payload = data[HEADER.size:]
+    if len(payload) != length or zlib.crc32(payload) != checksum:
+        return None
+    try:
+        return decode(payload)
+    except (ValueError, EOFError, TypeError, KeyError):
+        return None
+
+
+def write_cache(filename, statements, stat, version, digest, flags=0):
+    payload = encode(statements)
+    header = HEADER.pack(MAGIC, flags, stat.st_mtime_ns, stat.st_size,
+                         version, digest, zlib.crc32(payload), len(payload))
+    temporary = '{}.{}.tmp'.format(filename, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(temporary, 'wb') as stream:
+            stream.write(header + payload)
+        os.replace(temporary, filename)
+    except OSError:
+        # Like bytecode caches, an unwritable cache only costs speed.
+        try:
+            os.unlink(temporary)
+        except OSError:
+            pass
+
+
+def load_statements(path, parser, cache_dir=None, check_hash=False):
+    """
+    Returns the statements in the script at path, parsed as parser would
+    parse them, from the cache when it is up to date.
+
+    The cache is validated against the script's modification time and
+    size, or against a digest of its content if check_hash is true, and
+    always against the version of the grammar.
+    """
+    filename = cache_path(path, cache_dir)
+    version = parser.grammar.version
+    with open(path, 'rb') as stream:
+        stat = os.fstat(stream.fileno())
+        data = None
+        digest = None
+        if check_hash:
+            data = stream.read()
+            digest = hashlib.sha1(data).digest()
+        statements = read_cache(filename, stat, version, digest)
+        if statements is not None:
+            return statements
+        if data is None:
+            data = stream.read()
+    if digest is None:
+        digest = hashlib.sha1(data).digest()
+    # Translate line endings as reading the file as text would.
+    text = data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+    statements = parse(text, parser)
+    write_cache(filename, statements, stat, version, digest,
+                CHECK_HASH if check_hash else 0)
+    return statements
+
+
+class SourceCommand(Command):
+    def __init__(self, shell):
+        super().__init__(name='source')
+        self.shell = shell
+        self.add_argument('--no-cache', dest='cache', action='store_false',
+                          help='parse the file without using the cache')
+        self.add_argument('--check-hash', action='store_true',
+                          help='validate the cache against the content of '
+                               'the file rather than its modification time')
+        self.add_argument('path')
+
+    def run(self, **options):
+        """
+        Run the commands in a file
+        """
+        shell = self.shell
+        shell.last_error = None
+        shell.run_file(**options)
+        if shell.last_error is not None:
+            raise shell.last_error
+
+
+if __name__ == '__main__':
+    import io
+    import shutil
+    import tempfile
+
+    from . import Shell
+
+    parses = []
+    parse_text = parse
+
+    def parse(text, parser):
+        parses.append(text)
+        return parse_text(text, parser)
+
+    directory = tempfile.mkdtemp()
+    script = os.path.join(directory, 'script.sh')
+    cache_dir = os.path.join(directory, 'cache')
+    parser = Parser()
+
+    def write(data, mtime_ns=None):
+        with open(script, 'wb') as stream:
+            stream.write(data)
+        if mtime_ns is not None:
+            os.utime(script, ns=(mtime_ns, mtime_ns))
+
+    def test(description, expected, parsed, check_hash=False):
+        del parses[:]
+        got = load_statements(script, parser, cache_dir, check_hash)
+        if got != expected or bool(parses) != parsed:
+            print('*' * 40)
+            print('{}:'.format(description))
+            print('\tExpected: {!r}, {}'.format(
+                expected, 'parsed' if parsed else 'cached'))
+            print('\tGot: {!r}, {}'.format(
+                got, 'parsed' if parses else 'cached'))
+
+    def rewrite_cache(change):
+        filename = cache_path(script, cache_dir)
+        with open(filename, 'rb') as stream:
+            data = stream.read()
+        with open(filename, 'wb') as stream:
+            stream.write(change(data))
+
+    def set_grammar(data, version):
+        fields = list(HEADER.unpack_from(data))
+        fields[4] = version
+        return HEADER.pack(*fields) + data[HEADER.size:]
+
+    try:
+        ab = [['echo', 'a'], ['echo', 'b']]
+        write(b'echo a\necho b\n', 10 ** 18)
+        test('First run', ab, True)
+        test('Unchanged', ab, False)
+        os.utime(script, ns=(2 * 10 ** 18, 2 * 10 ** 18))
+        test('Changed mtime', ab, True)
+        write(b'echo a\necho bb\n', 2 * 10 ** 18)
+        test('Changed size', [['echo', 'a'], ['echo', 'bb']], True)
+        write(b'echo a\necho b\n', 10 ** 18)
+        test('Changed back', ab, True)
+
+        rewrite_cache(lambda data: data[:len(data) // 2])
+        test('Truncated cache', ab, True)
+        rewrite_cache(lambda data: data[:HEADER.size - 1])
+        test('Truncated header', ab, True)
+        rewrite_cache(lambda data: data[:-1] + bytes([data[-1] ^ 1]))
+        test('Corrupt payload', ab, True)
+        rewrite_cache(lambda data: b'garbage' * 20)
+        test('Garbage cache', ab, True)
+        rewrite_cache(lambda data: b'')
+        test('Empty cache', ab, True)
+        rewrite_cache(lambda data: set_grammar(data, b'\0' * 20))
+        test('Other grammar version', ab, True)
+        test('Cache rewritten', ab, False)
+
+        test('Check hash, same content', ab, False, check_hash=True)
+        os.utime(script, ns=(3 * 10 ** 18, 3 * 10 ** 18))
+        test('Check hash, changed mtime', ab, False, check_hash=True)
+        write(b'echo a\necho c\n', 3 * 10 ** 18)
+        test('Check hash, same size and mtime',
+             [['echo', 'a'], ['echo', 'c']], True, check_hash=True)
+        test('Hashed entry without check hash', [['echo', 'a'], ['echo', 'c']],
+             True)
+
+        write(b'echo a\r\necho b\r\n')
+        test('CRLF', ab, True)
+        test('CRLF cached', ab, False)
+        write(b'echo a\recho b\r')
+        test('CR', ab, True)
+
+        shell = Shell(stdout=io.StringIO(), source_cache_dir=cache_dir)
+        write(b'echo "a b"\r\necho c\r\n')
+        for run in ('parsed', 'cached'):
+            with shell.capture() as captured:
+                shell.run_file(script)
+            if captured.getvalue() != 'a b\nc\n':
+                print('*' * 40)
+                print('CRLF script run by the shell, {}:'.format(run))
+                print('\tGot: {!r}'.format(captured.getvalue()))
+    finally:
+        shutil.rmtree(directory)
@@ -1,51 +1,85 @@
+readline = None
 
-import os
-import shlex
 
-try:
-    import readline
-except ImportError:
-    readline = None
+def import_readline():
+    """
+    Import readline on first interactive use, so that scripts and pipes
+    never load it.  Returns None if it is unavailable.
+    """
+    global readline
+    if readline is None:
+        try:
+            import readline as module
+        except ImportError:
+            module = False
+        readline = module
+    return readline or None
 
 
 class InputStream:
+    block_size = 1 << 20
+
     def __init__(self, shell, stdin):
         self.stdin = stdin
         self.stdout = shell.stdout
+        self.output = shell.output
         self.parser = shell.parser
         self.get_prompt = shell.get_prompt
+        self.shell = shell
+        self.matches = []
         self.use_rawinput = shell.use_rawinput
         self.completekey = shell.completekey
         self.isatty = stdin.isatty()
-        self.history = shell.history and os.path.expanduser(shell.history)
+        self.history = None
+        self.history_length = shell.history_length
 
     def complete(self, text, state):
-        pass
+        if state == 0:
+            if (self.history is not None and text.startswith('!') and
+                    len(text) > 1 and readline.get_begidx() == 0):
+                # !TEXT finds earlier lines containing TEXT in the whole
+                # history, which readline's own search cannot reach.
+                self.matches = list(dict.fromkeys(
+                    line for _, line in self.history.search(text[1:])))
+            else:
+                self.matches = self.shell.completer.complete(
+                    readline.get_line_buffer(), readline.get_begidx(), text)
+        try:
+            return self.matches[state]
+        except IndexError:
+            return None
 
     def __enter__(self):
+        if self.isatty and self.use_rawinput:
+            import_readline()
         if readline and self.use_rawinput and self.completekey:
             self.old_completer = readline.get_completer()
+            self.old_delimiters = readline.get_completer_delims()
             readline.set_completer(self.complete)
+            readline.set_completer_delims(' \t\n;|&')
             readline.parse_and_bind(self.completekey + ": complete")
-            if self.history:
-                try:
-                    readline.read_history_file(self.history)
-                except FileNotFoundError:
-                    pass
+            self.history = self.shell.history_store
+            if self.history is not None:
+                for _, line in self.history.recent(self.history_length):
+                    readline.add_history(line)
 
     def __exit__(self, exc, obj, tb):
         if exc is EOFError:
             return True
         if readline and self.use_rawinput and self.completekey:
             readline.set_completer(self.old_completer)
-            if self.history:
-                readline.write_history_file(self.history)
+            readline.set_completer_delims(self.old_delimiters)
 
     def readline(self):
-        continued = not self.parser.is_complete()
+        self.output.flush()
+        continued = (not self.parser.is_complete() or
+                     self.shell.construct is not None)
         prompt = self.get_prompt(continued) if self.isatty else ''
         if self.use_rawinput:
-            return input(prompt)
+            line = input(prompt)
+            if self.history is not None and line.strip():
+                self.history.append(line)
+            return line
         else:
             if self.isatty:
                 self.stdout.write(prompt)
@@ -59,3 +93,14 @@ class InputStream:
         with self:
             while True:
                 yield self.readline()
+
+    def blocks(self):
+        """
+        Yields the rest of stdin in large blocks, bypassing prompts and
+        readline.
+        """
+        while True:
+            block = self.stdin.read(self.block_size)
+            if not block:
+                return
+            yield block
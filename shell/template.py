@@ -0,0 +1,100 @@
+
+import functools
+import string
+
+formatter = string.Formatter()
+
+
+def is_positional(field):
+    name = field.partition('.')[0].partition('[')[0]
+    return not name or name.isdigit()
+
+
+class Template:
+    """
+    A str.format template parsed once into literal text and fields, which
+    are rendered without parsing it again.  Rendering looks up only the
+    fields it refers to, and text without any fields is returned as is.
+
+    >>> Template('{{literal}}').render({})
+    '{literal}'
+
+    >>> class Loud(dict):
+    ...   def __getitem__(self, key):
+    ...     print('lookup', key)
+    ...     return super().__getitem__(key)
+
+    >>> Template('{a}-{a!r}').render(Loud(a='x', b='y'))
+    lookup a
+    lookup a
+    "x-'x'"
+
+    >>> Template('[{a[1]:>{width}}] {b.real:.1f}').render(
+    ...     dict(a='xy', width=3, b=2))
+    '[  y] 2.0'
+    """
+    def __init__(self, text):
+        self.text = text
+        self.pieces = []
+        fields = []
+        for literal, field, spec, conversion in formatter.parse(text):
+            if literal:
+                self.pieces.append(literal)
+            if field is None:
+                continue
+            fields.append(field)
+            if '{' in spec:
+                spec = Template(spec)
+            # Plain names are looked up directly, the rest by get_field.
+            simple = field.isidentifier()
+            self.pieces.append((field, simple, conversion, spec))
+        self.fields = tuple(fields)
+        if not self.fields:
+            self.constant = ''.join(self.pieces)
+        else:
+            self.constant = None
+            if any(is_positional(field) for field in self.fields):
+                # Left to str.format_map, which rejects them.
+                self.pieces = None
+
+    def render(self, mapping):
+        if self.constant is not None:
+            return self.constant
+        if self.pieces is None:
+            return self.text.format_map(mapping)
+        parts = []
+        for piece in self.pieces:
+            if type(piece) is str:
+                parts.append(piece)
+                continue
+            field, simple, conversion, spec = piece
+            if simple:
+                value = mapping[field]
+            else:
+                value = formatter.get_field(field, (), mapping)[0]
+            if conversion is not None:
+                value = formatter.convert_field(value, conversion)
+            if type(spec) is Template:
+                spec = spec.render(mapping)
+            parts.append(format(value, spec))
+        return ''.join(parts)
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_template(text):
+    return Template(text)
+
+
+def expand(text, mapping):
+    """
+    Format text with values from mapping, which is only asked for the
+    fields text refers to.
+    """
+    if '{' not in text and '}' not in text:
+        return text
+    return compile_template(text).render(mapping)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()